@@ -209,6 +209,8 @@ man_pages = [
      AUTHORS, 1),
     ('manpages/ibid-factpack.1', 'ibid-factpack',
      u'Factoid-package management utility for Ibid', AUTHORS, 1),
+    ('manpages/ibid-index-logs.1', 'ibid-index-logs',
+     u'Channel log search indexing utility for Ibid', AUTHORS, 1),
     ('manpages/ibid.ini.5', 'ibid.ini', u'Configuration file for Ibid',
      AUTHORS, 5),
     ('manpages/ibid-knab-import.1', 'ibid-knab-import',
@@ -12,6 +12,7 @@ from ConfigParser import SafeConfigParser
 sys.path.insert(0, '%s/lib' % dirname(__file__))
 
 import twisted.python.log
+from twisted.internet import reactor
 
 import ibid.core
 from ibid.compat import defaultdict
@@ -136,6 +137,9 @@ def setup(opts, service=None):
     ibid.reloader.load_sources(service)
     ibid.reloader.reload_auth()
 
+    reactor.addSystemEventTrigger('before', 'shutdown',
+            lambda: ibid.reloader.shutdown_processors())
+
 def reload_reloader():
     try:
         reload(ibid.core)
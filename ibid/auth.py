@@ -1,17 +1,18 @@
 # Copyright (c) 2008-2009, Michael Gorven
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
-from time import time
 from random import choice
 import string
 import logging
 import re
 
 from sqlalchemy import or_
+from twisted.internet import defer
 
 import ibid
 from ibid.compat import hashlib
 from ibid.db.models import Credential, Permission
+from ibid.utils.cache import LRUCache
 
 def hash(password, salt=None):
     if salt:
@@ -21,44 +22,103 @@ def hash(password, salt=None):
         salt = ''.join([choice(chars) for i in xrange(8)])
     return unicode(salt + hashlib.sha1(salt + password).hexdigest())
 
-def permission(name, account, source, session):
-    if account:
-        permission = session.query(Permission) \
-                .filter_by(account_id=account, name=name) \
-                .first()
-
-        if permission:
-            return permission.value
+permission_re = re.compile(r'^([+-]?)(\S+)$')
+permission_values = {'+': 'yes', '-': 'no', '': 'auth'}
 
-    permissions = []
-    permissions.extend(ibid.sources[source].permissions)
-    if 'permissions' in ibid.config.auth:
-        permissions.extend(ibid.config.auth['permissions'])
-
-    permission_re = re.compile('^([+-]?)(\S+)$')
+def compile_permissions(permissions):
+    "Turn a list of [+-]name rules into {name: value}. The first rule wins"
+    rules = {}
     for permission in permissions:
         match = permission_re.match(permission)
-        if match and match.group(2) == name :
-            if match.group(1) == '+':
-                return 'yes'
-            elif match.group(1) == '-':
-                return 'no'
-            else:
-                return 'auth'
+        if match and match.group(2) not in rules:
+            rules[match.group(2)] = permission_values[match.group(1)]
+    return rules
+
+# source -> {name: value}, from the configuration
+source_rules = {}
+# account id -> {name: value}, from the permissions table
+account_rules = LRUCache(1000)
+
+def source_permissions(source):
+    "Return the configured permission rules for source"
+    rules = source_rules.get(source)
+    if rules is None:
+        permissions = []
+        permissions.extend(ibid.sources[source].permissions)
+        if 'permissions' in ibid.config.auth:
+            permissions.extend(ibid.config.auth['permissions'])
+        rules = source_rules[source] = compile_permissions(permissions)
+    return rules
+
+def account_permissions(account, session):
+    "Return the permissions granted or revoked for account"
+    rules = account_rules.get(account)
+    if rules is None:
+        rules = dict(session.query(Permission.name, Permission.value)
+                            .filter_by(account_id=account).all())
+        account_rules[account] = rules
+    return rules
 
-    return 'no'
+def permission(name, account, source, session):
+    if account:
+        value = account_permissions(account, session).get(name)
+        if value:
+            return value
+
+    return source_permissions(source).get(name, 'no')
+
+class AuthenticationPending(Exception):
+    """Raised by an authentication method that has to wait for a reply.
+    function(*args) is called in the reactor thread and returns a Deferred
+    firing with the result. The dispatcher releases the worker thread while
+    it waits, and then resumes processing the event from the handler that
+    asked for authentication.
+    That handler is run again from the start. The responses it added and
+    its uncommitted database changes are discarded first, so handlers
+    must authenticate before committing anything or having other side
+    effects.
+    """
+
+    def __init__(self, function, *args):
+        Exception.__init__(self, function, args)
+        self.function = function
+        self.args = args
+        self.method = None
+
+    def start(self, event):
+        "Start waiting for the result, storing it on event for the retry"
+        def store(result):
+            event.setdefault('auth_results', {})[self.method] = bool(result)
+        def failed(failure):
+            logging.getLogger('core.auth').error(
+                    u"Exception occured in %s auth method: %s",
+                    self.method, failure.getTraceback())
+            store(False)
+        return defer.maybeDeferred(self.function, *self.args) \
+                .addCallbacks(store, failed)
 
 class Auth(object):
 
     def __init__(self):
-        self.authentication_cache = {}
-        self.authorisation_cache = {}
         self.log = logging.getLogger('core.auth')
+        self.drop_caches()
 
     def drop_caches(self):
         "Authentication / Authorisation data changed"
-        self.authentication_cache = {}
-        self.authorisation_cache = {}
+        config = ibid.config.auth
+        size = config.get('cache_size', 10000)
+        # A timeout of 0 means authentications are never cached
+        self.authentication_cache = None
+        if config['timeout']:
+            self.authentication_cache = LRUCache(size, config['timeout'])
+        self.authorisation_cache = LRUCache(size, config.get('cache_ttl', 3600))
+        source_rules.clear()
+        account_rules.clear()
+
+    def invalidate_account(self, account):
+        "An account's permissions changed"
+        self.authorisation_cache.discard(lambda key, value: key[1] == account)
+        account_rules.pop(account)
 
     def authenticate(self, event, credential=None):
         if 'account' not in event or not event.account:
@@ -70,30 +130,41 @@ class Auth(object):
         methods.extend(ibid.sources[event.source].auth)
         methods.extend(config['methods'])
 
-        if event.sender['connection'] in self.authentication_cache:
-            timestamp = self.authentication_cache[event.sender['connection']]
-            if time() - timestamp < ibid.config.auth['timeout']:
-                self.log.debug(u"Authenticated %s/%s (%s) from cache", event.account, event.identity, event.sender['connection'])
-                return True
-            else:
-                del self.authentication_cache[event.sender['connection']]
+        cache = self.authentication_cache
+        if cache is not None and event.sender['connection'] in cache:
+            self.log.debug(u"Authenticated %s/%s (%s) from cache", event.account, event.identity, event.sender['connection'])
+            return True
 
+        # Results of methods that answered asynchronously, see
+        # AuthenticationPending
+        results = event.get('auth_results', {})
         for method in methods:
-            if hasattr(ibid.sources[event.source], 'auth_%s' % method):
-                function = getattr(ibid.sources[event.source], 'auth_%s' % method)
-            elif hasattr(self, method):
-                function = getattr(self, method)
+            if method in results:
+                authenticated = results[method]
             else:
-                self.log.warning(u"Couldn't find authentication method %s", method)
-                continue
-
-            try:
-                if function(event, credential):
-                    self.log.info(u"Authenticated %s/%s (%s) using %s", event.account, event.identity, event.sender['connection'], method)
-                    self.authentication_cache[event.sender['connection']] = time()
-                    return True
-            except:
-                self.log.exception(u"Exception occured in %s auth method", method)
+                if hasattr(ibid.sources[event.source], 'auth_%s' % method):
+                    function = getattr(ibid.sources[event.source], 'auth_%s' % method)
+                elif hasattr(self, method):
+                    function = getattr(self, method)
+                else:
+                    self.log.warning(u"Couldn't find authentication method %s", method)
+                    continue
+
+                try:
+                    authenticated = function(event, credential)
+                except AuthenticationPending, e:
+                    self.log.debug(u"Waiting for %s to authenticate %s/%s (%s)", method, event.account, event.identity, event.sender['connection'])
+                    e.method = method
+                    raise
+                except:
+                    self.log.exception(u"Exception occured in %s auth method", method)
+                    continue
+
+            if authenticated:
+                self.log.info(u"Authenticated %s/%s (%s) using %s", event.account, event.identity, event.sender['connection'], method)
+                if cache is not None:
+                    cache[event.sender['connection']] = True
+                return True
 
         self.log.info(u"Authentication for %s/%s (%s) failed", event.account, event.identity, event.sender['connection'])
         return False
@@ -101,14 +172,14 @@ class Auth(object):
     def authorise(self, event, name):
         "Check if event comes from a user with permission 'name'"
         key = (name, event.account, event.source)
-        if key not in self.authorisation_cache:
+        value = self.authorisation_cache.get(key)
+        if value is None:
             value = permission(session=event.session, *key)
             self.authorisation_cache[key] = value
             self.log.info(u"Checking %s permission for %s/%s (%s): %s",
                     name, event.account, event.identity,
                     event.sender['connection'], value)
         else:
-            value = self.authorisation_cache[key]
             self.log.debug(u"Checking %s permission for %s/%s (%s) from cache: %s",
                     name, event.account, event.identity,
                     event.sender['connection'], value)
@@ -10,7 +10,7 @@ import socket
 from os.path import join, expanduser
 import sys
 
-from twisted.internet import reactor, threads
+from twisted.internet import reactor, threads, defer
 from twisted.python.modules import getModule
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
@@ -22,11 +22,30 @@ from ibid.db import SchemaVersionException, schema_version_check
 from ibid.utils import JSONException
 
 import auth
+from auth import AuthenticationPending
 
 def process(event, log):
-    for processor in ibid.processors:
+    processors = ibid.processors
+    if 'resume_processor' in event:
+        processor = event.pop('resume_processor')
+        if processor not in processors:
+            log.warning(u"Dropping event, %s processor of %s plugin was "
+                        u"unloaded while it waited for authentication: %s",
+                        processor.__class__.__name__, processor.name, event)
+            event.processed = True
+            return
+        processors = processors[processors.index(processor):]
+
+    for processor in processors:
         try:
             processor.process(event)
+        except AuthenticationPending, e:
+            # Resumed from this handler by Dispatcher._resume
+            event.resume_processor = processor
+            event.auth_pending = e
+            if 'session' in event:
+                event.session.rollback()
+            break
         except Exception, e:
             log.exception(
                     u'Exception occured in %s processor of %s plugin.\n'
@@ -65,6 +84,8 @@ class Dispatcher(object):
 
     def _process(self, event):
         process(event, self.log)
+        if 'auth_pending' in event:
+            return event
 
         log_level = logging.DEBUG
         if event.type == u'clock' and not event.processed:
@@ -97,7 +118,21 @@ class Dispatcher(object):
             log_level -= 5
         self.log.log(log_level, u"Received event from %s source", event.source)
 
-        return threads.deferToThread(self._process, event)
+        return threads.deferToThread(self._process, event) \
+                .addCallback(self._resume)
+
+    def _resume(self, event):
+        """Wait for a pending authentication without holding a thread, then
+        carry on processing event in one.
+        """
+        if 'auth_pending' not in event:
+            return event
+
+        pending = event.pop('auth_pending')
+        return pending.start(event) \
+                .addCallback(lambda result:
+                        threads.deferToThread(self._process, event)) \
+                .addCallback(self._resume)
 
     def call_later(self, delay, callable, oldevent, *args, **kw):
         "Run callable after delay seconds. Pass args and kw to it"
@@ -118,8 +153,12 @@ class Dispatcher(object):
             self.log.exception(u'Call Later')
 
     def delayed_response(self, event):
-        for response in event.responses:
-            ibid.sources[event.source].send(response)
+        def send(event):
+            for response in event.responses:
+                ibid.sources[event.source].send(response)
+        defer.maybeDeferred(self._resume, event).addCallback(send) \
+                .addErrback(lambda failure: self.log.error(
+                    u'Call Later: %s', failure.getTraceback()))
 
 class Reloader(object):
 
@@ -264,6 +303,15 @@ class Reloader(object):
         self.log.debug(u"Loaded %s plugin", name)
         return True
 
+    def shutdown_processors(self):
+        "Give every processor a chance to clean up, before the reactor stops"
+        for processor in ibid.processors:
+            try:
+                processor.shutdown()
+            except:
+                self.log.exception(u"Exception occured shutting down %s processor of %s plugin",
+                        processor.__class__.__name__, processor.name)
+
     def unload_processor(self, name):
         processors = []
 
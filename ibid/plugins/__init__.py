@@ -23,6 +23,7 @@ except ImportError:
             if not os.path.exists(os.path.join(x, *package + ['__init__.py']))]
 
 import ibid
+from ibid.auth import AuthenticationPending
 from ibid.compat import json, defaultdict
 from ibid.utils import url_regex
 
@@ -117,7 +118,10 @@ class Processor(object):
 
     def process(self, event):
         "Process a single event"
-        if event.type == 'clock':
+        # Set when resuming an event after AuthenticationPending
+        resume = event.pop('resume_handler', 0)
+
+        if event.type == 'clock' and not resume:
             for method in self._get_periodic_handlers():
                 self._run_periodic_handler(method, event)
 
@@ -131,7 +135,7 @@ class Processor(object):
             return
 
         found = False
-        for method in self._get_event_handlers():
+        for index, method in enumerate(self._get_event_handlers()):
             args = None
             if not hasattr(method, 'pattern'):
                 found = True
@@ -158,15 +162,30 @@ class Processor(object):
                                 assert value is None, (
                                     'named argument %s was matched more '
                                     'than once.' % name)
-            if args is not None:
-                if (not getattr(method, 'auth_required', False)
-                        or auth_responses(event, self.permission)):
-                    if isinstance(args, dict):
-                        method(event, **args)
+            if args is not None and index >= resume:
+                responses = len(event.responses)
+                state = event.processed, event.get('complain')
+                try:
+                    if (not getattr(method, 'auth_required', False)
+                            or auth_responses(event, self.permission)):
+                        if isinstance(args, dict):
+                            method(event, **args)
+                        else:
+                            method(event, *args)
+                    elif not getattr(method, 'auth_fallthrough', True):
+                        event.processed = True
+                except AuthenticationPending:
+                    # The handler is run again from the start, so forget
+                    # what it has done so far. core.process rolls back the
+                    # session.
+                    del event.responses[responses:]
+                    event.processed = state[0]
+                    if state[1] is None:
+                        event.pop('complain', None)
                     else:
-                        method(event, *args)
-                elif not getattr(method, 'auth_fallthrough', True):
-                    event.processed = True
+                        event.complain = state[1]
+                    event.resume_handler = index
+                    raise
 
         if not found:
             raise RuntimeError(u'No handlers found in %s' % self)
@@ -1,7 +1,12 @@
 # Copyright (c) 2009-2010, Michael Gorven, Stefano Rivera, Max Rabkin
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from bisect import bisect_right
+import os
+from select import select
 from subprocess import Popen, PIPE
+from threading import Lock, Semaphore
+from time import time
 from urllib import urlencode
 import logging
 import re
@@ -10,9 +15,10 @@ import unicodedata
 import ibid
 from ibid.plugins import Processor, handler, match
 from ibid.compat import any, defaultdict, ElementTree
-from ibid.config import Option
+from ibid.config import Option, BoolOption, IntOption, FloatOption
 from ibid.utils import (cacheable_download, file_in_path, get_country_codes,
                         human_join, unicode_output, generic_webservice)
+from ibid.utils.cache import LRUCache
 from ibid.utils.html import get_html_parse_tree
 
 features = {}
@@ -223,12 +229,177 @@ features['units'] = {
     'description': 'Converts values between various units.',
     'categories': ('convert',),
 }
+class UnitsError(Exception):
+    pass
+
+# Input that interactive units treats as a command, or as the previous
+# result, where the units command line would take it as a unit
+units_command_re = re.compile(
+        r'^\s*(?:help|search|quit|exit|\?)(?:\s|$)|(?<!\w)_(?!\w)|^\s*$'
+        r'|[\x00-\x1f]', re.I | re.UNICODE)
+
+class UnitsProcess(object):
+    """A GNU units process, running interactively.
+    Requests and responses are framed by its "You have:" and "You want:"
+    prompts.
+    """
+
+    prompts = ('You have: ', 'You want: ')
+
+    def __init__(self, command, timeout):
+        devnull = open(os.devnull, 'w')
+        try:
+            self.process = Popen(command, stdin=PIPE, stdout=PIPE,
+                                 stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+        self.buffer = ''
+        try:
+            output, prompt = self._read(timeout)
+            if prompt != 'You have: ':
+                raise UnitsError(u'Unexpected prompt from units: %s'
+                                 % prompt)
+        except:
+            self.kill()
+            raise
+
+    def _write(self, line):
+        try:
+            self.process.stdin.write(line.encode('utf-8') + '\n')
+            self.process.stdin.flush()
+        except IOError, e:
+            raise UnitsError(u'Lost units process: %s' % e)
+
+    def _read(self, timeout):
+        "Read up to the next prompt. Returns (output, prompt)"
+        deadline = time() + timeout
+        fd = self.process.stdout.fileno()
+        while True:
+            for prompt in self.prompts:
+                if self.buffer.endswith(prompt):
+                    output = self.buffer[:-len(prompt)]
+                    self.buffer = ''
+                    return output, prompt
+            remaining = deadline - time()
+            if remaining <= 0 or not select([fd], [], [], remaining)[0]:
+                raise UnitsError(u'Timed out waiting for units')
+            data = os.read(fd, 4096)
+            if not data:
+                raise UnitsError(u'units exited')
+            self.buffer += data
+
+    def convert(self, frm, to, timeout):
+        """Convert frm to to.
+        Returns (code, output), where code is the exit status the units
+        command line would have given.
+        """
+        self._write(frm)
+        output, prompt = self._read(timeout)
+        if prompt == 'You have: ':
+            # units rejected frm, and is asking again
+            return 1, output
+
+        self._write(to)
+        output, prompt = self._read(timeout)
+        if prompt == 'You want: ':
+            # units rejected to. An empty answer takes us back to the start.
+            self._write(u'')
+            self._read(timeout)
+            return 1, output
+
+        if output.lstrip().startswith('conformability error'):
+            return 1, output
+        return 0, output
+
+    def kill(self):
+        try:
+            os.kill(self.process.pid, 9)
+            self.process.wait()
+        except OSError:
+            pass
+
+class UnitsPool(object):
+    """A pool of at most size UnitsProcesses.
+    If a process doesn't show its first prompt, the pool stops starting
+    them.
+    """
+
+    def __init__(self, command, size, timeout):
+        self.command = command
+        self.timeout = timeout
+        self.slots = Semaphore(size)
+        self.idle = []
+        self.lock = Lock()
+        self.closed = False
+        self.broken = False
+
+    def accepts(self, frm, to):
+        """Can frm be converted to to here, with the same result as the
+        units command line?
+        """
+        return not self.broken and not units_command_re.search(frm) \
+                and not units_command_re.search(to)
+
+    def convert(self, frm, to):
+        """Convert frm to to, in an idle process or a new one.
+        Processes that fail or time out are killed, and replaced next time.
+        """
+        self.slots.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                process = self.idle and self.idle.pop() or None
+            finally:
+                self.lock.release()
+
+            if process is None:
+                try:
+                    process = UnitsProcess(self.command, self.timeout)
+                except UnitsError:
+                    self.broken = True
+                    raise
+
+            try:
+                result = process.convert(frm, to, self.timeout)
+            except:
+                process.kill()
+                raise
+
+            self.lock.acquire()
+            try:
+                if self.closed:
+                    process.kill()
+                else:
+                    self.idle.append(process)
+            finally:
+                self.lock.release()
+            return result
+        finally:
+            self.slots.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            for process in self.idle:
+                process.kill()
+            self.idle = []
+        finally:
+            self.lock.release()
+
 class Units(Processor):
     usage = u'convert [<value>] <unit> to <unit>'
     features = ('units',)
     priority = 10
 
     units = Option('units', 'Path to units executable', 'units')
+    interactive = BoolOption('interactive',
+        'Keep units processes running between conversions. Needs stdbuf',
+        False)
+    processes = IntOption('processes',
+        'Number of units processes to keep running', 2)
+    timeout = FloatOption('timeout',
+        'Time to wait for a conversion (in seconds)', 5.0)
 
     temp_scale_names = {
         'fahrenheit': 'tempF',
@@ -244,9 +415,27 @@ class Units(Processor):
 
     temp_function_names = set(temp_scale_names.values())
 
+    pool = None
+
     def setup(self):
+        super(Units, self).setup()
         if not file_in_path(self.units):
             raise Exception("Cannot locate units executable")
+        self.shutdown()
+        if self.interactive:
+            # units doesn't flush its prompts when writing to a pipe
+            if file_in_path('stdbuf'):
+                self.pool = UnitsPool(
+                        ['stdbuf', '-o0', self.units, '--verbose'],
+                        self.processes, self.timeout)
+            else:
+                log.warning(u"Can't run units interactively without stdbuf")
+        self.results = LRUCache(1000)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def format_temperature(self, unit):
         "Return the unit, and convert to 'tempX' format if a known temperature scale"
@@ -274,12 +463,10 @@ class Units(Processor):
             else:
                 frm = '%s %s' % (value, frm)
 
-        units = Popen([self.units, '--verbose', '--', frm, to], stdout=PIPE, stderr=PIPE)
-        output, error = units.communicate()
-        code = units.wait()
-
-        output = unicode_output(output)
-        result = output.splitlines()[0].strip()
+        code, result = self.results.get((frm, to), (None, None))
+        if code is None:
+            code, result = self._convert(frm, to)
+            self.results[(frm, to)] = code, result
 
         if code == 0:
             event.addresponse(result)
@@ -298,6 +485,24 @@ class Units(Processor):
             else:
                 event.addresponse(u"I can't do that: %s", result)
 
+    def _convert(self, frm, to):
+        "Returns the units exit status, and the first line of its output"
+        pool = self.pool
+        if pool is not None and pool.accepts(frm, to):
+            try:
+                code, output = pool.convert(frm, to)
+                return code, unicode_output(output).splitlines()[0].strip()
+            except (UnitsError, OSError, IndexError), e:
+                log.warning(u'Falling back to running units once: %s',
+                            unicode(e))
+
+        units = Popen([self.units, '--verbose', '--', frm, to], stdout=PIPE, stderr=PIPE)
+        output, error = units.communicate()
+        code = units.wait()
+
+        output = unicode_output(output)
+        return code, output.splitlines()[0].strip()
+
 features['currency'] = {
     'description': u'Converts amounts between currencies.',
     'categories': ('convert',),
@@ -308,9 +513,17 @@ class Currency(Processor):
 
     features = ('currency',)
 
+    rate_ttl = IntOption('rate_ttl',
+        'Time to cache exchange rates for (in seconds)', 60)
+
     currencies = {}
     country_codes = {}
 
+    def setup(self):
+        super(Currency, self).setup()
+        self.resolved = LRUCache(1000)
+        self.rates = LRUCache(1000, self.rate_ttl)
+
     def _load_currencies(self):
         iso4127_file = cacheable_download(
                 'http://www.currency-iso.org/dam/downloads/table_a1.xml',
@@ -383,14 +596,76 @@ class Currency(Processor):
         self.currencies['XCD'][0].append(u'Organisation of Eastern Caribbean States')
         self.currencies['XOF'][0].append(u'Coop\xe9ration financi\xe8re en Afrique centrale')
         self.currencies['XPF'][0].append(u'Comptoirs Fran\xe7ais du Pacifique')
+
+        self._index_currencies()
         return accociated_all_countries
 
+    def _index_currencies(self):
+        """Build the lookup tables for resolve_currency().
+        Everything is indexed in the order that currencies and country_codes
+        iterate in, so that the first match is the same one a linear search
+        would find.
+        """
+        # Lower-cased currency name or title-cased place -> (order, code)
+        self.currency_names = {}
+        self.currency_places = {}
+        # Lower-cased country name -> currency code
+        self.country_names = {}
+        # Newline-separated lower-cased names, for substring searches, and
+        # the code for each line
+        currency_text = []
+        self.currency_text_starts = []
+        self.currency_text_codes = []
+        country_text = []
+        self.country_text_starts = []
+        self.country_text_codes = []
+
+        offset = 0
+        for order, (code, (places, currency, units)) in \
+                enumerate(self.currencies.iteritems()):
+            self.currency_names.setdefault(currency.lower(), (order, code))
+            for place in places:
+                self.currency_places.setdefault(place, (order, code))
+            for text in [currency] + places:
+                text = text.lower()
+                currency_text.append(text)
+                self.currency_text_starts.append(offset)
+                self.currency_text_codes.append(code)
+                offset += len(text) + 1
+        self.currency_text = u'\n'.join(currency_text)
+
+        offset = 0
+        for code, place in self.country_codes.iteritems():
+            if code not in self.country_currencies:
+                continue
+            place = place.lower()
+            self.country_names.setdefault(place, self.country_currencies[code])
+            country_text.append(place)
+            self.country_text_starts.append(offset)
+            self.country_text_codes.append(self.country_currencies[code])
+            offset += len(place) + 1
+        self.country_text = u'\n'.join(country_text)
+
+    def _find_text(self, text, starts, codes, name):
+        "Return the code for the first line of text containing name"
+        offset = text.find(name)
+        if offset == -1:
+            return None
+        return codes[bisect_right(starts, offset) - 1]
+
     def resolve_currency(self, name, rough=True, plural_recursion=False):
         "Return the canonical name for a currency"
 
         if not self.currencies:
             self._load_currencies()
 
+        code = self.resolved.get((name, rough, plural_recursion))
+        if code is None:
+            code = self.resolved[(name, rough, plural_recursion)] = \
+                    self._resolve_currency(name, rough, plural_recursion)
+        return code
+
+    def _resolve_currency(self, name, rough, plural_recursion):
         if name.upper() in self.currencies:
             return name.upper()
 
@@ -409,28 +684,27 @@ class Currency(Processor):
             return "USD"
         if name == u'pound':
             return "GBP"
-        for code, (places, currency, units) in self.currencies.iteritems():
-            if name == currency.lower():
-                return code
-            if name.title() in places:
-                return code
+        matches = [match for match in (self.currency_names.get(name),
+                                       self.currency_places.get(name.title()))
+                   if match is not None]
+        if matches:
+            return min(matches)[1]
 
         # There are also country names in country_codes:
-        for code, place in self.country_codes.iteritems():
-            if name == place.lower() and code in self.country_currencies:
-                return self.country_currencies[code]
+        if name in self.country_names:
+            return self.country_names[name]
 
         # Second pass, not requiring exact match:
         if rough:
-            for code, (places, currency, units) in self.currencies.iteritems():
-                if name in currency.lower():
-                    return code
-                if any(name in place.lower() for place in places):
-                    return code
+            code = self._find_text(self.currency_text,
+                    self.currency_text_starts, self.currency_text_codes, name)
+            if code is not None:
+                return code
 
-            for code, place in self.country_codes.iteritems():
-                if name in place.lower() and code in self.country_currencies:
-                    return self.country_currencies[code]
+            code = self._find_text(self.country_text,
+                    self.country_text_starts, self.country_text_codes, name)
+            if code is not None:
+                return code
 
         # Maybe it's a plural?
         if name.endswith('s') and not plural_recursion:
@@ -459,13 +733,17 @@ class Currency(Processor):
             })
             return
 
-        data = generic_webservice(
-                'http://download.finance.yahoo.com/d/quotes.csv', {
-                    'f': 'l1ba',
-                    'e': '.csv',
-                    's': canonical_frm + canonical_to + '=X',
-                })
-        last_trade_rate, bid, ask = data.strip().split(',')
+        rate = self.rates.get((canonical_frm, canonical_to))
+        if rate is None:
+            data = generic_webservice(
+                    'http://download.finance.yahoo.com/d/quotes.csv', {
+                        'f': 'l1ba',
+                        'e': '.csv',
+                        's': canonical_frm + canonical_to + '=X',
+                    })
+            rate = self.rates[(canonical_frm, canonical_to)] = \
+                    data.strip().split(',')
+        last_trade_rate, bid, ask = rate
         if last_trade_rate == 0:
             event.addresponse(
                     u"Whoops, looks like I couldn't make that conversion")
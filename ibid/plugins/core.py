@@ -287,6 +287,11 @@ class ChannelTracker(Processor):
                 ibid.channels.pop(event.source, None)
             elif event.status == u'left':
                 ibid.channels[event.source].pop(event.channel, None)
+            elif event.status == u'members':
+                channel = ibid.channels[event.source][event.channel]
+                for member in event.members:
+                    if 'identity' in member:
+                        channel.add(member['identity'])
         elif event.public:
             if event.state == u'online' and hasattr(event, 'othername'):
                 oldid = identify(event.session, event.source, event.othername)
@@ -5,11 +5,14 @@ from datetime import datetime
 import logging
 from random import choice
 import re
+from threading import Lock
 
 from dateutil.tz import tzlocal, tzutc
+from sqlalchemy.sql import select
 
+import ibid
 from ibid.plugins import Processor, match, handler, authorise, auth_responses, \
-                         RPC
+                         periodic, RPC
 from ibid.config import Option, IntOption, ListOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Boolean, Integer, DateTime, \
                     Table, Column, ForeignKey, PassiveDefault, \
@@ -279,6 +282,150 @@ def get_factoid(session, name, number, pattern, is_regex, all=False,
         return []
     return None
 
+def _load_factoids(bind, factoid_ids=None):
+    """Load {factoid id: (names, ((value id, value), ...))}, for all factoids
+    or only those in factoid_ids.
+    """
+    names_table = FactoidName.__table__
+    values_table = FactoidValue.__table__
+    names_query = select([names_table.c.factoid_id, names_table.c._name])
+    values_query = select([values_table.c.factoid_id, values_table.c.id,
+                           values_table.c.value]).order_by(values_table.c.id)
+    if factoid_ids is not None:
+        names_query = names_query.where(
+                names_table.c.factoid_id.in_(factoid_ids))
+        values_query = values_query.where(
+                values_table.c.factoid_id.in_(factoid_ids))
+
+    factoids = {}
+    for factoid_id, name in bind.execute(names_query):
+        factoids.setdefault(factoid_id, ([], []))[0].append(unescape_name(name))
+    for factoid_id, value_id, value in bind.execute(values_query):
+        factoids.setdefault(factoid_id, ([], []))[1].append((value_id, value))
+
+    return dict((factoid_id, (tuple(names), tuple(values)))
+                for factoid_id, (names, values) in factoids.iteritems()
+                if names and values)
+
+def _wild_re(name):
+    "Compile a $arg factoid name, matching as the reversed LIKE does"
+    return re.compile(u'^%s$' % re.escape(name).replace(r'\$arg', '.+'),
+                      re.I | re.U | re.DOTALL)
+
+class FactoidSnapshot(object):
+    """An immutable, versioned view of all factoid names and values.
+    Readers use the current snapshot without locking, writers replace it
+    copy-on-write (see update_snapshot).
+    """
+
+    def __init__(self, version, factoids, names=None, wild=None):
+        self.version = version
+        # factoid id -> (names, ((value id, value), ...))
+        self.factoids = factoids
+        if names is None:
+            names, wild = {}, {}
+            for factoid_id, (fnames, values) in factoids.iteritems():
+                self._add_names(names, wild, factoid_id, fnames)
+        # lower-cased literal name -> (name, factoid id)
+        self.names = names
+        # $arg name -> (compiled name, factoid id)
+        self.wild = wild
+
+    def _add_names(self, names, wild, factoid_id, fnames):
+        for name in fnames:
+            if u'$arg' in name:
+                wild[name] = (_wild_re(name), factoid_id)
+            else:
+                names[name.lower()] = (name, factoid_id)
+
+    def patch(self, factoids, factoid_ids):
+        """Return a new snapshot with factoid_ids replaced by the contents of
+        factoids (those absent from it have been deleted).
+        """
+        new_factoids = self.factoids.copy()
+        names = self.names.copy()
+        wild = self.wild.copy()
+        for factoid_id in factoid_ids:
+            if factoid_id in new_factoids:
+                for name in new_factoids.pop(factoid_id)[0]:
+                    if u'$arg' in name:
+                        wild.pop(name, None)
+                    else:
+                        names.pop(name.lower(), None)
+        for factoid_id, (fnames, values) in factoids.iteritems():
+            new_factoids[factoid_id] = (fnames, values)
+            self._add_names(names, wild, factoid_id, fnames)
+        return FactoidSnapshot(self.version + 1, new_factoids, names, wild)
+
+    def _exact(self, name):
+        if name.lower() in self.names:
+            return (self.names[name.lower()],)
+        return ()
+
+    def _wild(self, name):
+        return [(fname, factoid_id)
+                for fname, (name_re, factoid_id) in self.wild.iteritems()
+                if name_re.match(name)]
+
+    def lookup(self, name, number=None, pattern=None, is_regex=False):
+        """Find a factoid as get_factoid() does for non-literal queries.
+        Returns (factoid id, name, value id, value), or None.
+        """
+        if pattern:
+            if is_regex:
+                pattern_re = re.compile(pattern, re.I)
+                matches = lambda value: pattern_re.search(value)
+            else:
+                pattern = pattern.lower()
+                matches = lambda value: pattern in value.lower()
+
+        for candidates in (self._exact, self._wild):
+            rows = []
+            for fname, factoid_id in candidates(name):
+                for value_id, value in self.factoids[factoid_id][1]:
+                    if not pattern or matches(value):
+                        rows.append((factoid_id, fname, value_id, value))
+            if not rows:
+                continue
+            if number is not None:
+                rows.sort(key=lambda row: row[2])
+                index = max(0, int(number) - 1)
+                if index < len(rows):
+                    return rows[index]
+                continue
+            return choice(rows)
+        return None
+
+_snapshot = None
+_snapshot_lock = Lock()
+
+def get_snapshot():
+    "Return the current FactoidSnapshot, loading it on first use"
+    snapshot = _snapshot
+    if snapshot is None:
+        snapshot = update_snapshot()
+    return snapshot
+
+def update_snapshot(factoid_ids=None, session=None):
+    """Replace the current FactoidSnapshot, after a write.
+    Only the factoids in factoid_ids are reloaded, if specified.
+    Uses session's database connection, if specified.
+    """
+    global _snapshot
+    if session is None:
+        session = ibid.databases.ibid()
+    _snapshot_lock.acquire()
+    try:
+        if factoid_ids is None:
+            version = _snapshot and _snapshot.version + 1 or 1
+            _snapshot = FactoidSnapshot(version, _load_factoids(session.bind))
+        elif _snapshot is not None:
+            _snapshot = _snapshot.patch(
+                    _load_factoids(session.bind, factoid_ids), factoid_ids)
+        return _snapshot
+    finally:
+        _snapshot_lock.release()
+
 class Utils(Processor):
     usage = u'literal <name> [( #<from number> | /<pattern>/[r] )]'
     features = ('factoid',)
@@ -318,7 +465,8 @@ class Forget(Processor):
         if factoids:
             factoidadmin = auth_responses(event, u'factoidadmin')
             identities = get_identities(event)
-            factoid = event.session.query(Factoid).get(factoids[0][0].id)
+            factoid_id = factoids[0][0].id
+            factoid = event.session.query(Factoid).get(factoid_id)
 
             if len(factoids) > 1 and pattern is not None:
                 event.addresponse(u'Pattern matches multiple factoids, please be more specific')
@@ -365,6 +513,7 @@ class Forget(Processor):
                             id, factoids[0][1].name, factoid.id, factoids[0][0].names[0].name,
                             event.account, event.identity, event.sender['connection'])
 
+            update_snapshot((factoid_id,), event.session)
             event.addresponse(True)
         else:
             factoids = get_factoid(event.session, name, None, pattern, is_regex, all=True, literal=True)
@@ -403,6 +552,7 @@ class Forget(Processor):
             factoid.names.append(name)
             event.session.add(factoid)
             event.session.commit()
+            update_snapshot((factoid.id,), event.session)
             event.addresponse(True)
             log.info(u"Added name '%s' to factoid %s (%s) by %s/%s (%s)",
                     name.name, factoid.id, factoid.names[0].name,
@@ -472,34 +622,81 @@ class Search(Processor):
         else:
             event.addresponse(u"I couldn't find anything that matched '%s'" % origpattern)
 
-def _interpolate(message, event):
-    "Expand factoid variables"
-    utcnow = datetime.utcnow()
-    now = utcnow.replace(tzinfo=tzutc()).astimezone(tzlocal())
-
-    substitutions = [(u'who', event.sender['nick']),
-            (u'channel', event.channel),
-            (u'source', event.source),
-            (u'year', unicode(now.year)),
-            (u'month2', u'%02i' % now.month),
-            (u'month1', unicode(now.month)),
-            (u'month', unicode(now.strftime('%B'))),
-            (u'mon', unicode(now.strftime('%b'))),
-            (u'day2', u'%02i' % now.day),
-            (u'day', unicode(now.day)),
-            (u'hour', unicode(now.hour)),
-            (u'minute', unicode(now.minute)),
-            (u'second', unicode(now.second)),
-            (u'date', format_date(utcnow, 'date')),
-            (u'time', format_date(utcnow, 'time')),
-            (u'dow', unicode(now.strftime('%A'))),
-            (u'weekday', unicode(now.strftime('%A'))),
-            (u'unixtime', unicode(utcnow.strftime('%s'))),
-        ]
-
-    for var, expansion in substitutions:
-        message = message.replace(u'$' + var, expansion)
-    return message
+def _now(event, cache):
+    "Local and UTC time, computed once per expansion"
+    if 'now' not in cache:
+        utcnow = datetime.utcnow()
+        cache['utcnow'] = utcnow
+        cache['now'] = utcnow.replace(tzinfo=tzutc()).astimezone(tzlocal())
+    return cache['now']
+
+def _utcnow(event, cache):
+    _now(event, cache)
+    return cache['utcnow']
+
+# Ordered as the variables were historically substituted, so that the
+# longest names win (e.g. $month2 before $month before $mon)
+factoid_variables = (
+    (u'who', lambda e, c: e.sender['nick']),
+    (u'channel', lambda e, c: e.channel),
+    (u'source', lambda e, c: e.source),
+    (u'year', lambda e, c: unicode(_now(e, c).year)),
+    (u'month2', lambda e, c: u'%02i' % _now(e, c).month),
+    (u'month1', lambda e, c: unicode(_now(e, c).month)),
+    (u'month', lambda e, c: unicode(_now(e, c).strftime('%B'))),
+    (u'mon', lambda e, c: unicode(_now(e, c).strftime('%b'))),
+    (u'day2', lambda e, c: u'%02i' % _now(e, c).day),
+    (u'day', lambda e, c: unicode(_now(e, c).day)),
+    (u'hour', lambda e, c: unicode(_now(e, c).hour)),
+    (u'minute', lambda e, c: unicode(_now(e, c).minute)),
+    (u'second', lambda e, c: unicode(_now(e, c).second)),
+    (u'date', lambda e, c: format_date(_utcnow(e, c), 'date')),
+    (u'time', lambda e, c: format_date(_utcnow(e, c), 'time')),
+    (u'dow', lambda e, c: unicode(_now(e, c).strftime('%A'))),
+    (u'weekday', lambda e, c: unicode(_now(e, c).strftime('%A'))),
+    (u'unixtime', lambda e, c: unicode(_utcnow(e, c).strftime('%s'))),
+)
+factoid_expansions = dict(factoid_variables)
+interpolate_re = re.compile(r'\$(%s|[1-9])'
+        % '|'.join(name for name, expansion in factoid_variables))
+
+class FactoidTemplate(object):
+    """A factoid value parsed once into literal text and $variables.
+    $1..$9 are expanded from the captured factoid name arguments.
+    """
+
+    def __init__(self, value):
+        self.value = value
+        self.parts = interpolate_re.split(value)
+
+    def expand(self, event, args=()):
+        if len(self.parts) == 1:
+            return self.value
+
+        cache = {}
+        parts = self.parts[:]
+        for i in xrange(1, len(parts), 2):
+            var = parts[i]
+            if var.isdigit():
+                if int(var) <= len(args):
+                    parts[i] = args[int(var) - 1]
+                else:
+                    parts[i] = u'$' + var
+            else:
+                parts[i] = factoid_expansions[var](event, cache)
+        return u''.join(parts)
+
+template_cache = {}
+template_cache_size = 1024
+
+def get_template(value_id, value):
+    "Return the compiled FactoidTemplate for a factoid value, cached by id"
+    template = template_cache.get(value_id)
+    if template is None or template.value != value:
+        if len(template_cache) >= template_cache_size:
+            template_cache.clear()
+        template = template_cache[value_id] = FactoidTemplate(value)
+    return template
 
 class Get(Processor, RPC):
     usage = u'<factoid> [( #<number> | /<pattern>/[r] )]'
@@ -509,6 +706,9 @@ class Get(Processor, RPC):
 
     interrogatives = ListOption('interrogatives', 'Question words to strip', default_interrogatives)
     verbs = ListOption('verbs', 'Verbs that split name from value', default_verbs)
+    snapshot_refresh = IntOption('snapshot_refresh',
+        u'Interval (in seconds) to reload all factoids, picking up changes '
+        u'made outside this bot (0 to disable)', 3600)
 
     def __init__(self, name):
         super(Get, self).__init__(name)
@@ -527,20 +727,20 @@ class Get(Processor, RPC):
             event.addresponse(response)
 
     def remote_get(self, name, number=None, pattern=None, is_regex=None, event={}):
-        factoid = get_factoid(event.session, name, number, pattern, is_regex)
+        factoid = get_snapshot().lookup(name, number, pattern, is_regex)
 
         if factoid:
-            (factoid, fname, fvalue) = factoid
-            reply = fvalue.value
-            oname = fname.name
-            pattern = re.escape(fname.name).replace(r'\$arg', '(.*)')
-            args = re.match(pattern, name, re.I | re.U).groups()
+            (factoid_id, fname, value_id, value) = factoid
+            oname = fname
+            args = ()
+            if u'$arg' in oname:
+                pattern = re.escape(fname).replace(r'\$arg', '(.*)')
+                args = re.match(pattern, name, re.I | re.U).groups()
 
-            for i, capture in enumerate(args):
-                reply = reply.replace('$%s' % (i + 1), capture)
-                oname = oname.replace('$arg', capture, 1)
+                for capture in args:
+                    oname = oname.replace('$arg', capture, 1)
 
-            reply = _interpolate(reply, event)
+            reply = get_template(value_id, value).expand(event, args)
 
             (reply, count) = action_re.subn('', reply)
             if count:
@@ -553,6 +753,15 @@ class Get(Processor, RPC):
             reply = u'%s %s' % (oname, reply)
             return reply
 
+    def remote_get_many(self, names, event={}):
+        "Look up several factoids at once, returning {name: response}"
+        return dict((name, self.remote_get(name, event=event))
+                    for name in names)
+
+    @periodic(config_key='snapshot_refresh', initial_delay=3600)
+    def refresh_snapshot(self, event):
+        update_snapshot(session=event.session)
+
 class Set(Processor):
     usage = u"""<name> (<verb>|=<verb>=) [also] <value>
     last set factoid"""
@@ -617,6 +826,7 @@ class Set(Processor):
         factoid.values.append(fvalue)
         event.session.add(factoid)
         event.session.commit()
+        update_snapshot((factoid.id,), event.session)
         self.last_set_factoid=factoid.names[0].name
         log.info(u"Added value '%s' to factoid %s (%s) by %s/%s (%s)",
                 fvalue.value, factoid.id, factoid.names[0].name,
@@ -678,6 +888,7 @@ class Modify(Processor):
             factoid[2].value += suffix
             event.session.add(factoid[2])
             event.session.commit()
+            update_snapshot((factoid[0].id,), event.session)
 
             log.info(u"Appended '%s' to value %s (%s) of factoid %s (%s) by %s/%s (%s)",
                     suffix, factoid[2].id, oldvalue, factoid[0].id,
@@ -780,6 +991,7 @@ class Modify(Processor):
 
             event.session.add(factoid[2])
             event.session.commit()
+            update_snapshot((factoid[0].id,), event.session)
 
             log.info(u"Applying '%s' to value %s (%s) of factoid %s (%s) by %s/%s (%s)",
                      operation, factoid[2].id, oldvalue, factoid[0].id,
@@ -820,6 +1032,51 @@ static_default = {
     },
 }
 
+# Inline global flags, named groups and numbered backreferences don't survive
+# being embedded in a larger alternation
+unsafe_static_re = re.compile(r'\(\?[iLmsux]+\)|\(\?P[<=]|\\\d')
+
+def compile_static(factoids):
+    """Compile static factoid patterns into as few regexes as possible.
+    Returns a list of (regex, owners), where owners maps the name of the last
+    matched group to the name of the factoid that fired (None for patterns
+    that had to be compiled on their own).
+    """
+    matchers = []
+    alternatives, owners, groups = [], {}, 0
+
+    for name, factoid in sorted(factoids.iteritems()):
+        matches = factoid['matches']
+        if isinstance(matches, basestring):
+            matches = [matches]
+        for pattern in matches:
+            try:
+                regex = re.compile(pattern, re.I | re.DOTALL)
+            except re.error, e:
+                log.warning(u"Ignoring invalid pattern '%s' in static factoid "
+                            u"%s: %s", pattern, name, e)
+                continue
+
+            if unsafe_static_re.search(pattern):
+                matchers.append((regex, {None: name}))
+                continue
+
+            # Python's re module is limited to 100 groups per pattern
+            if alternatives and groups + regex.groups + 1 > 99:
+                matchers.append((re.compile(u'|'.join(alternatives),
+                                            re.I | re.DOTALL), owners))
+                alternatives, owners, groups = [], {}, 0
+
+            group = 's%i' % len(owners)
+            alternatives.append(u'(?P<%s>%s)' % (group, pattern))
+            owners[group] = name
+            groups += regex.groups + 1
+
+    if alternatives:
+        matchers.append((re.compile(u'|'.join(alternatives), re.I | re.DOTALL),
+                         owners))
+    return matchers
+
 class StaticFactoid(Processor):
     priority = 900
 
@@ -828,14 +1085,24 @@ class StaticFactoid(Processor):
     def setup(self):
         self.factoids = static_default.copy()
         self.factoids.update(self.extras)
+        self.matchers = compile_static(self.factoids)
+        self.responses = {}
+        for name, factoid in self.factoids.iteritems():
+            responses = factoid['responses']
+            if isinstance(responses, basestring):
+                responses = [responses]
+            self.responses[name] = [FactoidTemplate(response)
+                                    for response in responses]
 
     @handler
     def static(self, event):
-        for factoid in self.factoids.values():
-            for match in factoid['matches']:
-                if re.search(match, event.message['stripped'], re.I|re.DOTALL):
-                    event.addresponse(_interpolate(choice(factoid['responses']), event),
-                            address=False)
-                    return
+        for regex, owners in self.matchers:
+            match = regex.search(event.message['stripped'])
+            if match:
+                responses = self.responses[owners.get(match.lastgroup,
+                                                      owners.get(None))]
+                event.addresponse(choice(responses).expand(event),
+                        address=False)
+                return
 
 # vi: set et sta sw=4 ts=4:
@@ -1,21 +1,29 @@
 # Copyright (c) 2009-2010, Michael Gorven, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from calendar import timegm
 from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
 import logging
+import os
 import re
-from threading import Lock
+import sys
+from threading import Condition, Lock, Semaphore, Thread
+from time import time
 from urllib2 import URLError
-from urlparse import urljoin
+from urlparse import urljoin, urlparse
 
 import feedparser
 from html2text import html2text_file
 
+from ibid.compat import hashlib
 from ibid.config import IntOption, FloatOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
-                    Table, Column, ForeignKey, Base, VersionedSchema
+                    Table, Column, ForeignKey, UniqueConstraint, Base, \
+                    VersionedSchema
 from ibid.plugins import Processor, match, authorise, periodic
 from ibid.utils import cacheable_download, human_join
+from ibid.utils.cache import LRUCache
 from ibid.utils.html import get_html_parse_tree
 
 features = {'feeds': {
@@ -25,6 +33,9 @@ features = {'feeds': {
 
 log = logging.getLogger('plugins.feeds')
 
+# parsed_feeds[cachefile] = (validator, parsed feed)
+parsed_feeds = LRUCache(200)
+
 class Feed(Base):
     __table__ = Table('feeds', Base.metadata,
     Column('id', Integer, primary_key=True),
@@ -80,14 +91,9 @@ class Feed(Base):
         self.time = datetime.utcnow()
         self.update()
 
-    def update(self, max_age=None):
-        headers = {}
-        if max_age:
-            headers['Cache-Control'] = 'max-age=%i' % max_age
-
-        feedfile = cacheable_download(self.url, "feeds/%s-%i.xml" % (
-                re.sub(r'\W+', '_', self.name), self.identity_id), headers)
-        self.feed = feedparser.parse(feedfile)
+    def update(self, max_age=None, response=None, timeout=60):
+        self.feed = download_feed(self.url, self.name, self.identity_id,
+                                  max_age, response, timeout)
         self.entries = self.feed['entries']
 
     def __unicode__(self):
@@ -100,6 +106,62 @@ class Feed(Base):
         else:
             return self.name
 
+def download_feed(url, name, identity_id, max_age=None, response=None,
+                  timeout=60):
+    """Download and parse a feed. The parsed feed is reused while the
+    downloaded file is unchanged.
+    """
+    headers = {}
+    if max_age:
+        headers['Cache-Control'] = 'max-age=%i' % max_age
+
+    if response is None:
+        response = {}
+    feedfile = cacheable_download(url, "feeds/%s-%i.xml" % (
+            re.sub(r'\W+', '_', name), identity_id), headers,
+            timeout=timeout, response=response)
+
+    stat = os.stat(feedfile)
+    validator = (stat.st_mtime, stat.st_size)
+    if response.get('headers') is not None:
+        validator += (response['headers'].get('etag'),)
+    cached = parsed_feeds.get(feedfile)
+    if cached is not None and (response.get('status') == 304
+                               or cached[0] == validator):
+        return cached[1]
+    parsed = feedparser.parse(feedfile)
+    parsed_feeds[feedfile] = (validator, parsed)
+    return parsed
+
+class FeedEntry(Base):
+    __table__ = Table('feed_entries', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('feed_id', Integer, ForeignKey('feeds.id'), nullable=False,
+           index=True),
+    Column('fingerprint', IbidUnicode(40), nullable=False),
+    Column('updated', DateTime),
+    UniqueConstraint('feed_id', 'fingerprint'),
+    useexisting=True)
+
+    __table__.versioned_schema = VersionedSchema(__table__, 1)
+
+    def __init__(self, feed_id, fingerprint, updated):
+        self.feed_id = feed_id
+        self.fingerprint = fingerprint
+        self.updated = updated
+
+def fingerprint(entry):
+    "Return a short, stable identifier for a feed entry"
+    id = entry.get('id', entry.title)
+    if isinstance(id, unicode):
+        id = id.encode('utf-8')
+    return unicode(hashlib.sha1(id).hexdigest())
+
+def entry_updated(entry):
+    if entry.get('updated_parsed'):
+        return datetime.utcfromtimestamp(timegm(entry.updated_parsed))
+    return None
+
 class Manage(Processor):
     usage = u"""
     add feed <url> as <name>
@@ -171,8 +233,12 @@ class Manage(Processor):
         if not feed:
             event.addresponse(u"I don't have the %s feed anyway", name)
         else:
+            event.session.query(FeedEntry).filter_by(feed_id=feed.id) \
+                    .delete(synchronize_session=False)
             event.session.delete(feed)
             event.session.commit()
+            Retrieve.last_seen.pop(feed.id, None)
+            Retrieve.last_parsed.pop(feed.id, None)
             log.info(u"Deleted feed '%s' by %s/%s (%s): %s", name,
                     event.account, event.identity,
                     event.sender['connection'], feed.url)
@@ -224,6 +290,14 @@ class Manage(Processor):
 broken_feeds = {}
 broken_lock = Lock()
 
+# next_poll[name] = time at which the feed should next be fetched
+next_poll = {}
+
+# Names of the feeds being fetched, including by fetches that outlived the
+# round that started them
+fetching = set()
+fetching_lock = Lock()
+
 class Retrieve(Processor):
     usage = u"""latest [ <count> ] ( articles | headlines ) from <name> [ starting at <number> ]
     article ( <number> | /<pattern>/ ) from <name>"""
@@ -234,7 +308,17 @@ class Retrieve(Processor):
         'Maximum feed poll interval for broken feeds (in seconds)', 86400)
     backoff_ratio = FloatOption('backoff',
         'The slowdown ratio to back off from broken feeds', 2.0)
-
+    max_poll_interval = IntOption('max_poll_interval',
+        'Maximum poll interval for feeds that rarely change (in seconds)',
+        300)
+    max_fetches = IntOption('max_fetches',
+        'Maximum number of feeds to fetch at once', 8)
+    max_host_fetches = IntOption('max_host_fetches',
+        'Maximum number of feeds to fetch from a single host at once', 2)
+    fetch_timeout = IntOption('fetch_timeout',
+        'Time to wait for a round of feed fetches (in seconds)', 120)
+    fetch_socket_timeout = IntOption('fetch_socket_timeout',
+        'Time to wait for a feed server to respond (in seconds)', 60)
 
     @match(r'^(?:latest|last)\s+(?:(\d+)\s+)?(article|headline)(s)?\s+from\s+(.+?)'
            r'(?:\s+start(?:ing)?\s+(?:at\s+|from\s+)?(\d+))?$')
@@ -328,71 +412,256 @@ class Retrieve(Processor):
             'summary': summary,
         })
 
+    # last_seen[feed_id] = {fingerprint: updated}
     last_seen = {}
+    # The parsed feed that last_seen was built from
+    last_parsed = {}
     @periodic(config_key='interval')
     def poll(self, event):
         feeds = event.session.query(Feed) \
                 .filter(Feed.source != None) \
                 .filter(Feed.target != None).all()
 
-        for feed in feeds:
-            broken_lock.acquire()
-            try:
-                if feed.name in broken_feeds:
+        fetching_lock.acquire()
+        try:
+            # Still being fetched by an earlier round
+            busy = set(fetching)
+        finally:
+            fetching_lock.release()
+
+        now = time()
+        due = []
+        broken_lock.acquire()
+        try:
+            for feed in feeds:
+                if feed.name in busy:
+                    continue
+                elif feed.name in broken_feeds:
                     last_exc, interval, time_since_fetch = broken_feeds[feed.name]
                     time_since_fetch += self.interval
                     if time_since_fetch < interval:
                         broken_feeds[feed.name] = \
                                 last_exc, interval, time_since_fetch
                         continue
+                elif next_poll.get(feed.name, 0) > now:
+                    continue
                 else:
                     last_exc = None
                     interval = time_since_fetch = self.interval
+                due.append((feed, last_exc, interval, time_since_fetch))
+        finally:
+            broken_lock.release()
 
-                try:
-                    feed.update(max_age=time_since_fetch)
-                except Exception, e:
+        results = self.fetch([item[0] for item in due],
+                             dict((item[0].name, item[3]) for item in due))
+
+        for feed, last_exc, interval, time_since_fetch in due:
+            if feed.name not in results:
+                log.warning(u'Timed out polling feed %s from %s',
+                            feed, feed.url)
+                continue
+            e, exc_info, response, parsed = results[feed.name]
+            if parsed is not None:
+                feed.feed = parsed
+                feed.entries = parsed['entries']
+            broken_lock.acquire()
+            try:
+                if e is not None:
                     if type(e) != type(last_exc):
                         if isinstance(e, URLError):
                             log.warning(u'Exception "%s" occured while polling '
                                         u'feed %s from %s', e, feed, feed.url)
                         else:
-                            log.exception(u'Exception "%s" occured while polling '
-                                          u'feed %s from %s', e, feed, feed.url)
+                            log.error(u'Exception "%s" occured while polling '
+                                      u'feed %s from %s', e, feed, feed.url,
+                                      exc_info=exc_info)
                     broken_feeds[feed.name] = e, self.backoff(interval), 0
                     continue
-                else:
-                    if feed.name in broken_feeds:
-                        del broken_feeds[feed.name]
+                elif feed.name in broken_feeds:
+                    del broken_feeds[feed.name]
             finally:
                 broken_lock.release()
 
+            next_poll[feed.name] = now + self.schedule(feed, response, now)
+
             if not feed.entries:
                 continue
 
-            if feed.name not in self.last_seen:
-                seen = {}
-                for entry in feed.entries:
-                    id = entry.get('id', entry.title)
-                    seen[id] = entry.updated_parsed
-                self.last_seen[feed.name] = seen
+            old_seen = self.seen_entries(event.session, feed)
+            if old_seen is not None \
+                    and self.last_parsed.get(feed.id) is feed.feed:
                 continue
+            self.last_parsed[feed.id] = feed.feed
 
-            old_seen = self.last_seen[feed.name]
             seen = {}
             for entry in reversed(feed.entries):
-                id = entry.get('id', entry.title)
-                seen[id] = entry.updated_parsed
-                if entry.updated_parsed != old_seen.get(id):
-                    event.addresponse(
-                        u"%(status)s item in %(feed)s: %(title)s%(link)s", {
-                            'status': id in old_seen and u'Updated' or u'New',
-                            'feed': feed.name,
-                            'title': entry.title,
-                            'link': get_link(entry),
-                        },
-                        source=feed.source, target=feed.target, adress=False)
-            self.last_seen[feed.name] = seen
+                seen[fingerprint(entry)] = entry_updated(entry)
+            changed = [entry for entry in reversed(feed.entries)
+                       if old_seen is None
+                       or seen[fingerprint(entry)] != old_seen.get(
+                           fingerprint(entry), False)]
+            self.store_entries(event.session, feed, old_seen or {}, seen)
+
+            if old_seen is None:
+                continue
+
+            for entry in changed:
+                event.addresponse(
+                    u"%(status)s item in %(feed)s: %(title)s%(link)s", {
+                        'status': fingerprint(entry) in old_seen
+                                  and u'Updated' or u'New',
+                        'feed': feed.name,
+                        'title': entry.title,
+                        'link': get_link(entry),
+                    },
+                    source=feed.source, target=feed.target, adress=False)
+
+    def seen_entries(self, session, feed):
+        """Return {fingerprint: updated} for the entries last seen in feed,
+        or None if it has never been polled.
+        """
+        if feed.id not in self.last_seen:
+            rows = session.query(FeedEntry.fingerprint, FeedEntry.updated) \
+                    .filter_by(feed_id=feed.id).all()
+            if not rows:
+                return None
+            self.last_seen[feed.id] = dict(rows)
+        return self.last_seen[feed.id]
+
+    def store_entries(self, session, feed, old_seen, seen):
+        "Bring the stored fingerprints for feed up to date with seen"
+        removed = [fp for fp in old_seen if fp not in seen]
+        if removed:
+            session.query(FeedEntry).filter_by(feed_id=feed.id) \
+                    .filter(FeedEntry.fingerprint.in_(removed)) \
+                    .delete(synchronize_session=False)
+        for fp, updated in seen.iteritems():
+            if fp not in old_seen:
+                session.add(FeedEntry(feed.id, fp, updated))
+            elif old_seen[fp] != updated:
+                session.query(FeedEntry) \
+                        .filter_by(feed_id=feed.id, fingerprint=fp) \
+                        .update({'updated': updated},
+                                synchronize_session=False)
+        session.commit()
+        self.last_seen[feed.id] = seen
+
+    def fetch(self, feeds, max_ages):
+        """Download feeds in parallel, with at most max_fetches fetches in
+        flight, and max_host_fetches against any one host.
+        Returns {name: (exception, exc_info, response, parsed feed)} for
+        the feeds that completed within fetch_timeout. Fetches still
+        running after that are left to finish on their own, and their
+        results are discarded.
+        """
+        results = {}
+        max_fetches = max(1, self.max_fetches)
+        socket_timeout = max(1, self.fetch_socket_timeout)
+        # Guards active and closed, and is notified when a fetch finishes
+        done = Condition()
+        active = [0]
+        closed = [False]
+        hosts = {}
+        for feed in feeds:
+            host = urlparse(feed.url)[1].lower()
+            if host not in hosts:
+                hosts[host] = Semaphore(max(1, self.max_host_fetches))
+
+        # The workers only see plain values, never the session's Feeds
+        def worker(name, url, identity_id, host_slots):
+            result = None
+            response = {}
+            host_slots.acquire()
+            try:
+                try:
+                    result = None, None, response, download_feed(url, name,
+                            identity_id, max_ages[name], response,
+                            socket_timeout)
+                except Exception, e:
+                    result = e, sys.exc_info(), response, None
+            finally:
+                host_slots.release()
+                fetching_lock.acquire()
+                try:
+                    fetching.discard(name)
+                finally:
+                    fetching_lock.release()
+                done.acquire()
+                try:
+                    if not closed[0] and result is not None:
+                        results[name] = result
+                    active[0] -= 1
+                    done.notify()
+                finally:
+                    done.release()
+
+        # Interleave hosts, so that one busy host doesn't hog the slots
+        queues = {}
+        for feed in feeds:
+            queues.setdefault(urlparse(feed.url)[1].lower(), []).append(
+                    (feed.name, feed.url, feed.identity_id))
+        ordered = []
+        while queues:
+            for host in sorted(queues.keys()):
+                ordered.append(queues[host].pop(0) + (hosts[host],))
+                if not queues[host]:
+                    del queues[host]
+
+        deadline = time() + self.fetch_timeout
+        done.acquire()
+        try:
+            for args in ordered:
+                while active[0] >= max_fetches and time() < deadline:
+                    done.wait(deadline - time())
+                if active[0] >= max_fetches:
+                    break
+                active[0] += 1
+                fetching_lock.acquire()
+                try:
+                    fetching.add(args[0])
+                finally:
+                    fetching_lock.release()
+                thread = Thread(target=worker, args=args,
+                                name=u'feed-%s' % args[0])
+                thread.setDaemon(True)
+                thread.start()
+            while active[0] and time() < deadline:
+                done.wait(deadline - time())
+            closed[0] = True
+            return dict(results)
+        finally:
+            done.release()
+
+    def schedule(self, feed, response, now):
+        """Work out how long to wait before fetching feed again, from the
+        interval between its recent entries and the HTTP caching headers.
+        """
+        interval = self.max_poll_interval
+
+        updates = sorted(timegm(entry.updated_parsed)
+                         for entry in feed.entries[:10]
+                         if entry.get('updated_parsed'))
+        if len(updates) > 1:
+            # Poll twice per average update interval
+            interval = min(interval,
+                (updates[-1] - updates[0]) / (len(updates) - 1) / 2)
+
+        headers = response.get('headers')
+        if headers is not None:
+            expires = None
+            m = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+            if m:
+                expires = int(m.group(1))
+            elif headers.get('Expires'):
+                parsed = parsedate_tz(headers['Expires'])
+                if parsed:
+                    expires = mktime_tz(parsed) - now
+            if expires is not None:
+                # Don't fetch before the server's copy expires
+                interval = max(interval,
+                               min(expires, self.max_poll_interval))
+
+        return max(self.interval, interval)
 
     def backoff(self, interval):
         return min(self.max_interval, interval*self.backoff_ratio)
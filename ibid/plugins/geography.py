@@ -19,6 +19,7 @@ from dateutil.tz import gettz, tzlocal, tzoffset
 
 from ibid.plugins import Processor, match
 from ibid.utils import json_webservice, human_join, format_date, cacheable_download
+from ibid.utils.cache import LRUCache
 from ibid.utils.html import get_html_parse_tree
 from ibid.config import Option, DictOption, IntOption
 from ibid.compat import defaultdict
@@ -347,6 +348,8 @@ CUSTOM_ZONES = {
     'EST': 'US/Eastern',
 }
 
+_missing = object()
+
 features['timezone'] = {
     'description': 'Converts times between timezones.',
     'categories': ('convert',),
@@ -358,12 +361,15 @@ class TimeZone(Processor):
 
     zoneinfo = Option('zoneinfo', 'Timezone info directory', '/usr/share/zoneinfo')
     custom_zones = DictOption('timezones', 'Custom timezone names', CUSTOM_ZONES)
+    cache_ttl = IntOption('cache_ttl',
+        'Time to cache geonames timezone lookups for (in seconds)', 86400)
 
     countries = {}
     timezones = {}
     lowerzones = {}
 
     def setup(self):
+        super(TimeZone, self).setup()
         iso3166 = join(self.zoneinfo, 'iso3166.tab')
         if exists(iso3166):
             self.countries = {}
@@ -389,44 +395,67 @@ class TimeZone(Processor):
                     name = join(path, filename).replace(self.zoneinfo, '').lstrip('/')
                     self.lowerzones[name.lower().replace('etc/', '')] = name
 
-    def _find_timezone(self, string):
+        # Lower-cased lookup maps for _find_timezone()
+        self.lower_custom_zones = {}
         for name, zonename in self.custom_zones.items():
-            if string.lower() == name.lower():
-                return gettz(zonename)
+            self.lower_custom_zones.setdefault(name.lower(), zonename)
+        self.lower_countries = {}
+        for code, name in self.countries.items():
+            self.lower_countries[name.lower()] = code
+        # Lower-cased component of a zone name -> zone names
+        self.zone_parts = defaultdict(list)
+        for zones in self.timezones.values():
+            for name in zones:
+                for part in set(part.lower() for part in name.split('/')):
+                    self.zone_parts[part].append(name)
+
+        # Resolved strings, tzinfo objects and geonames lookups
+        self.resolved = LRUCache(1000, self.cache_ttl)
+        self.tzinfos = LRUCache(1000)
+        self.geonames = LRUCache(1000, self.cache_ttl)
+
+    def _gettz(self, name):
+        zone = self.tzinfos.get(name, _missing)
+        if zone is _missing:
+            zone = self.tzinfos[name] = gettz(name)
+        return zone
+
+    def _find_timezone(self, string):
+        zone = self.resolved.get(string)
+        if zone is None:
+            zone = self.resolved[string] = self._resolve_timezone(string)
+        return zone
 
-        zone = gettz(string)
+    def _resolve_timezone(self, string):
+        if string.lower() in self.lower_custom_zones:
+            return self._gettz(self.lower_custom_zones[string.lower()])
+
+        zone = self._gettz(string)
         if zone:
             return zone
 
-        zone = gettz(string.upper())
+        zone = self._gettz(string.upper())
         if zone:
             return zone
 
         if string.lower() in self.lowerzones:
-            return gettz(self.lowerzones[string.lower()])
+            return self._gettz(self.lowerzones[string.lower()])
 
-        ccode = None
-        for code, name in self.countries.items():
-            if name.lower() == string.lower():
-                ccode = code
+        ccode = self.lower_countries.get(string.lower())
         if not ccode:
             if string.replace('.', '').upper() in self.timezones:
                 ccode = string.replace('.', '').upper()
 
         if ccode:
             if len(self.timezones[ccode]) == 1:
-                return gettz(self.timezones[ccode][0])
+                return self._gettz(self.timezones[ccode][0])
             else:
                 raise TimezoneException(u'%s has multiple timezones: %s' % (self.countries[ccode], human_join(self.timezones[ccode])))
 
-        possibles = []
-        for zones in self.timezones.values():
-            for name in zones:
-                if string.replace(' ', '_').lower() in [part.lower() for part in name.split('/')]:
-                    possibles.append(name)
+        possibles = self.zone_parts.get(string.replace(' ', '_').lower(), [])
 
         if len(possibles) == 1:
-            return gettz(possibles[0])
+            return self._gettz(possibles[0])
         elif len(possibles) > 1:
             raise TimezoneException(u'Multiple timezones found: %s' % (human_join(possibles)))
 
@@ -437,6 +466,13 @@ class TimeZone(Processor):
         raise TimezoneException(u"I don't know about the %s timezone" % (string,))
 
     def _geonames_lookup(self, place):
+        zone = self.geonames.get(place.lower(), _missing)
+        if zone is _missing:
+            zone = self.geonames[place.lower()] = \
+                    self._geonames_query(place)
+        return zone
+
+    def _geonames_query(self, place):
         search = json_webservice('http://ws.geonames.org/searchJSON', {'q': place, 'maxRows': 1, 'username': 'ibid'})
         if search['totalResultsCount'] == 0:
             return None
@@ -445,7 +481,7 @@ class TimeZone(Processor):
         timezone = json_webservice('http://ws.geonames.org/timezoneJSON', {'lat': city['lat'], 'lng': city['lng'], 'username': 'ibid'})
 
         if 'timezoneId' in timezone:
-            return gettz(timezone['timezoneId'])
+            return self._gettz(timezone['timezoneId'])
 
         if 'rawOffset' in timezone:
             offset = timezone['rawOffset']
@@ -526,6 +562,14 @@ class FlightSearch(Processor):
     max_results = IntOption('max_results', 'Maximum number of results to list', 5)
 
     airports = {}
+    # Indexes into airports, built by read_airport_data():
+    # Lower-cased IATA and ICAO code -> ids
+    iata = {}
+    icao = {}
+    # Lower-cased word in the name, city, country or codes -> set of ids
+    airport_words = {}
+    # id -> position in airports, to list results in a consistent order
+    airport_order = {}
 
     def read_airport_data(self):
         # File is listed as ISO 8859-1 (Latin-1) encoded on
@@ -536,6 +580,16 @@ class FlightSearch(Processor):
         for row in reader:
             self.airports[int(row[0])] = [unicode(r, u'utf-8') for r in row[1:]]
 
+        for index in (self.iata, self.icao, self.airport_words,
+                      self.airport_order):
+            index.clear()
+        for position, (id, airport) in enumerate(self.airports.items()):
+            self.airport_order[id] = position
+            self.iata.setdefault(airport[3].lower(), []).append(id)
+            self.icao.setdefault(airport[4].lower(), []).append(id)
+            for word in u' '.join(c.lower() for c in airport[:5]).split():
+                self.airport_words.setdefault(word, set()).add(id)
+
     def _airport_search(self, query, search_loc = True):
         if not self.airports:
             self.read_airport_data()
@@ -543,20 +597,21 @@ class FlightSearch(Processor):
             ids = self._airport_search(query, False)
             if len(ids) == 1:
                 return ids
-            query = [q for q in query.lower().split()]
-        else:
-            query = [query.lower()]
-        ids = []
-        for id, airport in self.airports.items():
-            if search_loc:
-                data = (u' '.join(c.lower() for c in airport[:5])).split()
-            elif len(query[0]) == 3:
-                data = [airport[3].lower()]
-            else: # assume length 4 (won't break if not)
-                data = [airport[4].lower()]
-            if len(filter(lambda q: q in data, query)) == len(query):
-                ids.append(id)
-        return ids
+            words = set(query.lower().split())
+            if not words:
+                ids = self.airports.keys()
+            else:
+                # Intersect the smallest posting lists first
+                postings = sorted((self.airport_words.get(word, set())
+                                   for word in words), key=len)
+                ids = set(postings[0])
+                for posting in postings[1:]:
+                    ids &= posting
+        elif len(query) == 3:
+            ids = self.iata.get(query.lower(), [])
+        else: # assume length 4 (won't break if not)
+            ids = self.icao.get(query.lower(), [])
+        return sorted(ids, key=self.airport_order.get)
 
     def repr_airport(self, id):
         airport = self.airports[id]
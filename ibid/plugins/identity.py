@@ -2,23 +2,44 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import string
+from datetime import datetime
 from random import choice
 import logging
 
+from sqlalchemy.sql import select
+
 import ibid
-from ibid.config import Option
+from ibid.config import Option, IntOption
 from ibid.compat import any
 from ibid.db import eagerload, IntegrityError, and_, or_
 from ibid.db.models import Account, Identity, Attribute, Credential, Permission
 from ibid.plugins import Processor, match, handler, auth_responses, authorise
 from ibid.utils import human_join
+from ibid.utils.cache import LRUCache
 from ibid.auth import hash
 
 features = {}
-identify_cache = {}
+# (source, connection) -> (identity id, account id)
+identify_cache = LRUCache(10000)
+# account id -> frozenset of identity ids
+account_identities = LRUCache(10000)
 
 log = logging.getLogger('plugins.identity')
 
+def invalidate_identity(identity_id, account_id=None):
+    """Forget cached lookups for an identity whose account has changed.
+    account_id is the account it now belongs to, if any.
+    """
+    identify_cache.discard(lambda key, value: value[0] == identity_id)
+    account_identities.discard(lambda key, value: identity_id in value)
+    if account_id is not None:
+        account_identities.pop(account_id)
+
+def invalidate_account(account_id):
+    "Forget cached lookups for all identities of an account"
+    identify_cache.discard(lambda key, value: value[1] == account_id)
+    account_identities.pop(account_id)
+
 features['accounts'] = {
     'description': u'Manage users accounts with the bot. An account represents '
                    u'a person. An account has one or more identities, which is '
@@ -76,7 +97,8 @@ class Accounts(Processor):
             log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
                     identity.id, identity.identity, identity.source, account.id, account.username)
 
-        identify_cache.clear()
+        if identity:
+            invalidate_identity(identity.id, account.id)
         event.addresponse(True)
 
     @match(r'^delete\s+(?:(my)\s+account|account\s+(.+))$')
@@ -102,7 +124,8 @@ class Accounts(Processor):
 
         event.session.delete(account)
         event.session.commit()
-        identify_cache.clear()
+        invalidate_account(account.id)
+        ibid.auth.invalidate_account(account.id)
 
         log.info(u"Deleted account %s (%s) by %s/%s (%s)",
                 account.id, account.username, event.account, event.identity, event.sender['connection'])
@@ -134,7 +157,6 @@ class Accounts(Processor):
 
         event.session.add(account)
         event.session.commit()
-        identify_cache.clear()
 
         log.info(u"Renamed account %s (%s) to %s by %s/%s (%s)",
                 account.id, oldname, account.username, event.account, event.identity, event.sender['connection'])
@@ -190,11 +212,10 @@ class Identities(Processor):
                     currentidentity.account_id = account.id
                     event.session.add(currentidentity)
 
-                    identify_cache.clear()
-
                     event.addresponse(u"I've created the account %s for you", username)
 
                     event.session.commit()
+                    invalidate_identity(currentidentity.id, account.id)
                     log.info(u"Created account %s (%s) by %s/%s (%s)",
                             account.id, account.username, event.account, event.identity, event.sender['connection'])
                     log.info(u"Attached identity %s (%s on %s) to account %s (%s)",
@@ -253,7 +274,7 @@ class Identities(Processor):
             event.session.add(ident)
             event.session.commit()
 
-            identify_cache.clear()
+            invalidate_identity(ident.id, account.id)
 
             event.addresponse(True)
             log.info(u"Attached identity %s (%s on %s) to account %s (%s) by %s/%s (%s)",
@@ -277,10 +298,10 @@ class Identities(Processor):
                 identity = Identity(source, user)
             identity.account_id = account_id
             event.session.add(identity)
-            identify_cache.clear()
 
             del self.tokens[token]
             event.session.commit()
+            invalidate_identity(identity.id, account_id)
 
             event.addresponse(u'Identity added')
 
@@ -311,7 +332,7 @@ class Identities(Processor):
             event.session.add(identity)
             event.session.commit()
 
-            identify_cache.clear()
+            invalidate_identity(identity.id)
 
             event.addresponse(True)
             log.info(u"Removed identity %s (%s on %s) from account %s (%s) by %s/%s (%s)",
@@ -453,11 +474,27 @@ class Identify(Processor):
     processed = True
     event_types = (u'message', u'state', u'action', u'notice', u'invite')
 
+    cache_size = IntOption('cache_size',
+            u'Maximum number of connections to cache identities for', 10000)
+
+    races = 0
+
+    def setup(self):
+        super(Identify, self).setup()
+        identify_cache.resize(self.cache_size)
+
+    def stats(self):
+        "Return identity cache statistics"
+        stats = identify_cache.stats()
+        stats['races'] = self.races
+        return stats
+
     @handler
     def handle(self, event):
         if event.sender:
-            if (event.source, event.sender['connection']) in identify_cache:
-                (event.identity, event.account) = identify_cache[(event.source, event.sender['connection'])]
+            cached = identify_cache.get((event.source, event.sender['connection']))
+            if cached is not None:
+                (event.identity, event.account) = cached
                 return
 
             identity = event.session.query(Identity) \
@@ -476,6 +513,7 @@ class Identify(Processor):
                     event.session.close()
                     del event['session']
                     log.debug(u'Race encountered creating identity for %s on %s', event.sender['id'], event.source)
+                    self.races += 1
                     identity = event.session.query(Identity) \
                             .options(eagerload('account')) \
                             .filter_by(source=event.source,
@@ -489,10 +527,89 @@ class Identify(Processor):
                 event.account = None
             identify_cache[(event.source, event.sender['connection'])] = (event.identity, event.account)
 
+class IdentifyMembers(Processor):
+    "Identify everyone present in a channel we've just joined, in bulk"
+
+    priority = -1600
+    addressed = False
+    processed = True
+    event_types = (u'source',)
+
+    @handler
+    def handle(self, event):
+        if event.status != u'members':
+            return
+
+        identities = identify_many(event.session, event.source,
+                                   [member['id'] for member in event.members])
+        for member in event.members:
+            if member['id'].lower() in identities:
+                member['identity'], member['account'] = \
+                        identities[member['id'].lower()]
+                identify_cache[(event.source, member['connection'])] = \
+                        (member['identity'], member['account'])
+
+# Stay well under SQLite's limit of 999 bound parameters
+bulk_chunk_size = 500
+
+def identify_many(session, source, names):
+    """Look up, creating where necessary, the identities for names on source.
+    Returns {lower-cased name: (identity id, account id)}.
+    """
+    table = Identity.__table__
+    identities = {}
+
+    def load(names):
+        for i in xrange(0, len(names), bulk_chunk_size):
+            query = select([table.c.identity, table.c.id, table.c.account_id],
+                    and_(table.c.source == source,
+                         table.c.identity.in_(names[i:i + bulk_chunk_size])))
+            for identity, id, account_id in session.execute(query):
+                identities[identity.lower()] = (id, account_id)
+
+    unique = {}
+    for name in names:
+        unique.setdefault(name.lower(), name)
+    load(unique.values())
+
+    missing = [name for key, name in unique.iteritems()
+               if key not in identities]
+    if missing:
+        created = datetime.utcnow()
+        rows = [{'source': source, 'identity': name, 'created': created}
+                for name in missing]
+        try:
+            session.execute(table.insert(), rows)
+            session.commit()
+        except IntegrityError:
+            # Somebody beat us to some of them, fall back to one at a time
+            session.rollback()
+            log.debug(u'Race encountered creating identities on %s', source)
+            for row in rows:
+                try:
+                    session.execute(table.insert(), row)
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+        log.info(u'Created %i identities on %s', len(missing), source)
+        load(missing)
+
+    return identities
+
+def get_account_identities(session, account_id):
+    "Return the ids of all the identities belonging to an account"
+    identities = account_identities.get(account_id)
+    if identities is None:
+        identities = frozenset(id for (id,) in
+                session.query(Identity.id).filter_by(account_id=account_id)
+                       .all())
+        account_identities[account_id] = identities
+    return identities
+
 def get_identities(event):
+    "Return the ids of all the identities belonging to the sender's account"
     if event.account:
-        account = event.session.query(Account).get(event.account)
-        return [identity.id for identity in account.identities]
+        return get_account_identities(event.session, event.account)
     else:
         return (event.identity,)
 
@@ -608,7 +725,7 @@ class Permissions(Processor):
             event.session.add(permission)
 
         event.session.commit()
-        ibid.auth.drop_caches()
+        ibid.auth.invalidate_account(account.id)
         log.info(u"%s %s permission for account %s (%s) by account %s",
                 actions[action.lower()], name, account.id, account.username, event.account)
 
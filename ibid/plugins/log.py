@@ -4,24 +4,282 @@
 
 """Logs messages sent and received."""
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from errno import EEXIST
 import fnmatch
+import gzip
 import logging
-from os.path import dirname, join, expanduser
-from os import chmod, makedirs
-from threading import Lock
-from weakref import WeakValueDictionary
-
+import re
+from os.path import dirname, exists, join, expanduser
+from os import chmod, makedirs, remove, stat, utime, walk
+from Queue import Queue, Empty
+from threading import Event as ThreadEvent, Thread
+from time import time
+
+from dateutil.parser import parse as parse_date
 from dateutil.tz import tzlocal, tzutc
+from sqlalchemy.sql import select
 
 import ibid
-from ibid.plugins import Processor, handler
-from ibid.config import Option, BoolOption, IntOption, ListOption
+from ibid.plugins import Processor, handler, match, periodic, RPC
+from ibid.config import Option, BoolOption, IntOption, FloatOption, ListOption
+from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
+                    Table, Column, ForeignKey, Base, VersionedSchema
 from ibid.event import Event
+from ibid.utils import format_date
+from ibid.utils.cache import LRUCache
 
 log = logging.getLogger('plugins.log')
 
+features = {'logsearch': {
+    'description': u'Searches the channel logs',
+    'categories': ('lookup', 'remember',),
+}}
+
+class LogLine(Base):
+    __table__ = Table('log_lines', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('source', IbidUnicode(32, case_insensitive=True), nullable=False,
+           index=True),
+    Column('channel', IbidUnicode(255, case_insensitive=True),
+           nullable=False, index=True),
+    Column('time', DateTime, nullable=False, index=True),
+    Column('type', IbidUnicode(8), nullable=False),
+    Column('nick', IbidUnicode(255, case_insensitive=True), nullable=False,
+           index=True),
+    Column('message', IbidUnicodeText, nullable=False),
+    useexisting=True)
+
+    __table__.versioned_schema = VersionedSchema(__table__, 1)
+
+    def __repr__(self):
+        return u'<LogLine %s %s/%s at %s: %s>' % (
+                self.nick, self.source, self.channel, self.time, self.message)
+
+class LogWord(Base):
+    __table__ = Table('log_words', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('word', IbidUnicode(32), nullable=False, index=True),
+    Column('line_id', Integer, ForeignKey('log_lines.id'), nullable=False,
+           index=True),
+    useexisting=True)
+
+    __table__.versioned_schema = VersionedSchema(__table__, 1)
+
+word_re = re.compile(r'\w{2,}', re.UNICODE)
+
+def tokenize(text):
+    "Return the set of indexable words in text"
+    return set(word[:32] for word in word_re.findall(text.lower()))
+
+def store_lines(session, lines):
+    """Add lines to the search index.
+    lines is a list of dicts with source, channel, time, type, nick and
+    message keys.
+    """
+    for line in lines:
+        line_id = session.execute(LogLine.__table__.insert(), line) \
+                         .inserted_primary_key[0]
+        words = [{'word': word, 'line_id': line_id}
+                 for word in tokenize(line['message'])]
+        if words:
+            session.execute(LogWord.__table__.insert(), words)
+
+def search_logs(session, terms, source=None, channel=None, nick=None,
+                since=None, until=None, limit=10):
+    "Return the most recent LogLines containing all the words in terms"
+    words = tokenize(terms)
+    if not words:
+        return []
+
+    log_words = LogWord.__table__
+    query = session.query(LogLine)
+    for word in words:
+        query = query.filter(LogLine.id.in_(
+                select([log_words.c.line_id], log_words.c.word == word)))
+    if source is not None:
+        query = query.filter_by(source=source)
+    if channel is not None:
+        query = query.filter_by(channel=channel)
+    if nick is not None:
+        query = query.filter_by(nick=nick)
+    if since is not None:
+        query = query.filter(LogLine.time >= since)
+    if until is not None:
+        query = query.filter(LogLine.time < until)
+
+    return query.order_by(LogLine.time.desc()).limit(limit).all()
+
+def format_regex(format):
+    "Turn a log format string into a regex, with a group for each field"
+    parts = re.split(r'%\((\w+)\)[-#0 +]*\d*[sd]', format)
+    regex = []
+    seen = set()
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            regex.append(re.escape(part))
+        elif part in seen:
+            regex.append(u'(?P=%s)' % part)
+        else:
+            seen.add(part)
+            if part in ('source', 'channel'):
+                regex.append(u'(?P<%s>[^/]+?)' % part)
+            elif part in ('year', 'month', 'day', 'hour', 'minute', 'second'):
+                regex.append(u'(?P<%s>\d+)' % part)
+            elif part == 'message':
+                regex.append(u'(?P<message>.*)')
+            else:
+                regex.append(u'(?P<%s>.+?)' % part)
+    return re.compile(u''.join(regex) + u'$', re.UNICODE)
+
+def compile_globs(globs):
+    "Compile source:channel globs into a list of (source, channel) regexes"
+    compiled = []
+    for glob in globs:
+        if u':' not in glob:
+            continue
+        source_glob, channel_glob = glob.split(u':', 1)
+        compiled.append((re.compile(fnmatch.translate(source_glob)),
+                         re.compile(fnmatch.translate(channel_glob))))
+    return compiled
+
+class LogWriter(Thread):
+    """Writes log lines in the background, so that logging never waits for
+    the disk. Lines are written to buffered files, which are flushed every
+    flush_interval seconds or every flush_size lines.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name='plugins.log.writer')
+        self.setDaemon(True)
+        self.queue = Queue()
+        self.files = LRUCache(5, on_evict=self._close)
+        # filename -> file, for files with unflushed lines
+        self.dirty = {}
+        self.pending = 0
+        # Lines waiting to be added to the search index
+        self.lines = []
+        self.dir_mode = 0755
+        self.flush_interval = 1.0
+        self.flush_size = 100
+
+    def configure(self, fd_cache, dir_mode, flush_interval, flush_size):
+        self.queue.put(('configure',
+                        (fd_cache, dir_mode, flush_interval, flush_size)))
+
+    def write(self, filename, mode, line):
+        "Append line to filename, creating it with mode if necessary"
+        self.queue.put(('write', (filename, mode, line)))
+
+    def index(self, line):
+        "Add line (see store_lines) to the search index"
+        self.queue.put(('index', (line,)))
+
+    def close(self, filename, timeout=None):
+        "Close filename if it is open, and wait for that to happen"
+        done = ThreadEvent()
+        self.queue.put(('close', (filename, done)))
+        done.wait(timeout)
+
+    def stop(self, timeout=None):
+        "Write out everything queued so far, and close all the files"
+        self.queue.put(('stop', None))
+        self.join(timeout)
+
+    def run(self):
+        next_flush = None
+        while True:
+            try:
+                if next_flush is None:
+                    command, args = self.queue.get()
+                else:
+                    command, args = self.queue.get(True,
+                            max(0, next_flush - time()))
+            except Empty:
+                self.flush()
+                next_flush = None
+                continue
+
+            try:
+                if command == 'write':
+                    self._write(*args)
+                elif command == 'index':
+                    self.lines.append(args[0])
+                    self.pending += 1
+                elif command == 'close':
+                    filename, done = args
+                    try:
+                        file = self.files.pop(filename)
+                        if file is not None:
+                            self._close(filename, file)
+                    finally:
+                        done.set()
+                elif command == 'configure':
+                    self._configure(*args)
+                elif command == 'stop':
+                    self.flush()
+                    for filename, file in self.files.items():
+                        file.close()
+                    self.files.clear()
+                    return
+            except:
+                log.exception(u'Error writing logs')
+
+            if self.pending >= self.flush_size:
+                self.flush()
+                next_flush = None
+            elif (self.dirty or self.lines) and next_flush is None:
+                next_flush = time() + self.flush_interval
+
+    def _configure(self, fd_cache, dir_mode, flush_interval, flush_size):
+        self.dir_mode = dir_mode
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.files.resize(fd_cache)
+
+    def _write(self, filename, mode, line):
+        file = self.files.get(filename)
+        if file is None:
+            try:
+                makedirs(dirname(filename), self.dir_mode)
+            except OSError, e:
+                if e.errno != EEXIST:
+                    raise e
+
+            file = open(filename, 'a')
+            chmod(filename, mode)
+            self.files[filename] = file
+
+        file.write(line)
+        self.dirty[filename] = file
+        self.pending += 1
+
+    def _close(self, filename, file):
+        self.dirty.pop(filename, None)
+        file.close()
+
+    def flush(self):
+        for filename, file in self.dirty.items():
+            try:
+                file.flush()
+            except IOError, e:
+                log.error(u"Couldn't flush %s: %s", filename, unicode(e))
+        self.dirty.clear()
+        self.pending = 0
+
+        if self.lines:
+            lines, self.lines = self.lines, []
+            session = ibid.databases.ibid()
+            try:
+                try:
+                    store_lines(session, lines)
+                    session.commit()
+                except:
+                    session.rollback()
+                    log.exception(u"Couldn't index %i log lines", len(lines))
+            finally:
+                session.close()
+
 class Log(Processor):
 
     addressed = False
@@ -64,13 +322,33 @@ class Log(Processor):
             [])
 
     fd_cache = IntOption('fd_cache', 'Number of log files to keep open.', 5)
+    flush_interval = FloatOption('flush_interval',
+            u'Seconds to buffer log lines for before writing them out', 1)
+    flush_size = IntOption('flush_size',
+            u'Number of buffered log lines that triggers a write', 100)
 
-    lock = Lock()
-    logs = WeakValueDictionary()
-    # Ensures that recently used FDs are still available in logs:
-    recent_logs = []
+    index = BoolOption('index',
+            u'Also store messages in a searchable index in the database',
+            False)
+
+    rotate_interval = IntOption('rotate_interval',
+            u'Seconds between looking for log files to compress or expire',
+            3600)
+    compress = BoolOption('compress',
+            u'Gzip log files once the period they cover is over', False)
+    retention = IntOption('retention',
+            u'Days to keep log files for, 0 to keep them forever', 0)
+
+    writer = None
 
     def setup(self):
+        super(Log, self).setup()
+        if self.writer is None or not self.writer.isAlive():
+            self.writer = LogWriter()
+            self.writer.start()
+        self.writer.configure(self.fd_cache, int(self.dir_mode, 8),
+                              self.flush_interval, self.flush_size)
+
         sources = list(set(ibid.config.sources.keys())
                        | set(ibid.sources.keys()))
         for globlistname in ["public_logs", "blacklist", "whitelist"]:
@@ -86,75 +364,67 @@ class Log(Processor):
                                 u'configured source matching "%s"',
                                 globlistname, glob, source_glob)
 
+        self.public_globs = compile_globs(self.public_logs)
+        self.blacklist_globs = compile_globs(self.blacklist)
+        self.whitelist_globs = compile_globs(self.whitelist)
+        # (source, channel, sender) -> (logged, file mode, source, channel)
+        self.policies = LRUCache(10000)
+
+    def shutdown(self):
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+
     def get_channel(self, event):
         if event.channel is not None:
             return ibid.sources[event.source].logging_name(event.channel)
         return ibid.sources[event.source].logging_name(event.sender['id'])
 
-    def matches(self, event, globlist):
-        channel = self.get_channel(event)
-
-        for glob in globlist:
-            if u':' not in glob:
-                continue
-            source_glob, channel_glob = glob.split(u':', 1)
-            if (fnmatch.fnmatch(event.source, source_glob)
-                    and fnmatch.fnmatch(channel, channel_glob)):
+    def matches(self, source, channel, globs):
+        for source_re, channel_re in globs:
+            if source_re.match(source) and channel_re.match(channel):
                 return True
-
         return False
 
-    def get_logfile(self, event):
-        self.lock.acquire()
-        try:
-            when = event.time
-            if not self.date_utc:
-                when = when.replace(tzinfo=tzutc()).astimezone(tzlocal())
-
+    def policy(self, event):
+        """Return (logged, file mode, source, channel) for event.
+        source and channel are escaped for use in filenames.
+        """
+        key = (event.source, event.channel,
+               event.channel is None and event.sender['id'] or None)
+        policy = self.policies.get(key)
+        if policy is None:
             channel = self.get_channel(event)
-
-            filename = self.log % {
-                    'source': event.source.replace('/', '-'),
-                    'channel': channel.replace('/', '-'),
-                    'year': when.year,
-                    'month': when.month,
-                    'day': when.day,
-                    'hour': when.hour,
-                    'minute': when.minute,
-                    'second': when.second,
-            }
-            filename = join(ibid.options['base'], expanduser(filename))
-            log = self.logs.get(filename, None)
-            if log is None:
-                try:
-                    makedirs(dirname(filename), int(self.dir_mode, 8))
-                except OSError, e:
-                    if e.errno != EEXIST:
-                        raise e
-
-                log = open(filename, 'a')
-                self.logs[filename] = log
-
-                if self.matches(event, self.public_logs):
-                    chmod(filename, int(self.public_mode, 8))
-                else:
-                    chmod(filename, int(self.private_mode, 8))
+            logged = not (
+                    self.matches(event.source, channel, self.blacklist_globs)
+                    and not self.matches(event.source, channel,
+                                         self.whitelist_globs))
+            if self.matches(event.source, channel, self.public_globs):
+                mode = int(self.public_mode, 8)
             else:
-                # recent_logs is an LRU cache, we'll be moving log to the
-                # front of the queue, if it's in the queue.
-                # It might not be, GCs are fickle LP: 655645
-                try:
-                    self.recent_logs.remove(log)
-                except ValueError:
-                    pass
-
-            self.recent_logs = [log] + self.recent_logs[:self.fd_cache - 1]
-            return log
-        finally:
-            self.lock.release()
+                mode = int(self.private_mode, 8)
+            policy = (logged, mode, event.source.replace('/', '-'),
+                      channel.replace('/', '-'))
+            self.policies[key] = policy
+        return policy
+
+    def get_logfile(self, source, channel, when):
+        "Return the filename to log to"
+        filename = self.log % {
+                'source': source,
+                'channel': channel,
+                'year': when.year,
+                'month': when.month,
+                'day': when.day,
+                'hour': when.hour,
+                'minute': when.minute,
+                'second': when.second,
+        }
+        return join(ibid.options['base'], expanduser(filename))
 
     def log_event(self, event):
-        if self.matches(event, self.blacklist) and not self.matches(event, self.whitelist):
+        logged, mode, source, channel = self.policy(event)
+        if not logged:
             return
 
         when = event.time
@@ -195,10 +465,190 @@ class Log(Processor):
         else:
             fields['message'] = event.message
 
-        file = self.get_logfile(event)
+        self.writer.write(self.get_logfile(source, channel, when), mode,
+                          (format % fields).encode('utf-8') + '\n')
+
+        # Private messages stay out of the index, the searches can't tell
+        # who was part of the conversation
+        if self.index and event.type != 'state' and event.get('public'):
+            self.writer.index({
+                'source': source,
+                'channel': channel,
+                'time': event.time,
+                'type': event.type,
+                'nick': event.sender['nick'],
+                'message': fields['message'],
+            })
+
+    def parse_logfile(self, filename):
+        """Parse a log file written with the current configuration.
+        Yields lines for store_lines.
+        """
+        compressed = filename.endswith('.gz')
+        if compressed:
+            plain = filename[:-3]
+        else:
+            plain = filename
+        match = format_regex(self.log).search(
+                plain.decode('utf-8', 'replace'))
+        if not match or 'source' not in match.groupdict() \
+                or 'channel' not in match.groupdict():
+            raise ValueError(u"%s doesn't match the log filename format"
+                             % filename)
+        source = match.group('source')
+        channel = match.group('channel')
+
+        formats = [(type, format_regex(format)) for type, format in (
+                    (u'message', self.message_format),
+                    (u'action', self.action_format),
+                    (u'notice', self.notice_format))]
+
+        if compressed:
+            file = gzip.open(filename, 'rb')
+        else:
+            file = open(filename)
+
+        for line in file:
+            line = line.rstrip('\r\n').decode('utf-8', 'replace')
+            for type, regex in formats:
+                match = regex.match(line)
+                if match:
+                    break
+            else:
+                continue
+
+            try:
+                when = parse_date(match.group('timestamp'))
+            except ValueError:
+                continue
+            if when.tzinfo is None:
+                if self.date_utc:
+                    when = when.replace(tzinfo=tzutc())
+                else:
+                    when = when.replace(tzinfo=tzlocal())
+            when = when.astimezone(tzutc()).replace(tzinfo=None)
+
+            yield {
+                'source': source,
+                'channel': channel,
+                'time': when,
+                'type': type,
+                'nick': match.group('sender_nick'),
+                'message': match.group('message'),
+            }
 
-        file.write((format % fields).encode('utf-8') + '\n')
-        file.flush()
+    def log_files(self):
+        "Yield (filename, fields) for every log file, compressed or not"
+        template = join(ibid.options['base'], expanduser(self.log))
+        regex = format_regex(template)
+        root = dirname(template.split(u'%(', 1)[0])
+        for dirpath, dirnames, filenames in walk(root):
+            for name in filenames:
+                filename = join(dirpath, name)
+                match = regex.match(filename.endswith(u'.gz')
+                                    and filename[:-3] or filename)
+                if match:
+                    yield filename, match.groupdict()
+
+    def period_over(self, fields, now):
+        """Is the period covered by a log file with these filename fields
+        over? Files without time fields in their names never close.
+        """
+        period = []
+        current = []
+        for unit in ('year', 'month', 'day', 'hour', 'minute', 'second'):
+            if unit not in fields:
+                break
+            period.append(int(fields[unit]))
+            current.append(getattr(now, unit))
+        return bool(period) and period < current
+
+    @periodic(config_key='rotate_interval', initial_delay=300)
+    def rotate(self, event):
+        "Compress and expire old log files"
+        self.rotate_logs(time())
+
+    def rotate_logs(self, timestamp):
+        """Compress and expire the log files whose periods were over at
+        timestamp (in seconds since the epoch)
+        """
+        if not self.compress and not self.retention:
+            return
+
+        if self.date_utc:
+            now = datetime.utcfromtimestamp(timestamp)
+        else:
+            now = datetime.fromtimestamp(timestamp, tzlocal())
+        # Allow for lines still queued for a period that just ended
+        settled = timestamp - 3600
+        expired = timestamp - self.retention * 24 * 60 * 60
+
+        compressed = expunged = 0
+        for filename, fields in self.log_files():
+            if not self.period_over(fields, now):
+                continue
+            mtime = stat(filename).st_mtime
+            if self.retention and mtime < expired:
+                remove(filename)
+                expunged += 1
+            elif (self.compress and not filename.endswith(u'.gz')
+                    and mtime < settled):
+                if self.writer is not None:
+                    self.writer.close(filename, 10)
+                self.compress_logfile(filename)
+                compressed += 1
+
+        if compressed or expunged:
+            log.info(u'Compressed %i and expired %i log files',
+                     compressed, expunged)
+
+    def compress_logfile(self, filename):
+        "Replace filename with a gzipped copy"
+        target = filename + '.gz'
+        # Appending adds a second gzip member, which readers handle
+        output = gzip.open(target, exists(target) and 'ab' or 'wb')
+        try:
+            input = open(filename, 'rb')
+            try:
+                while True:
+                    data = input.read(65536)
+                    if not data:
+                        break
+                    output.write(data)
+            finally:
+                input.close()
+        finally:
+            output.close()
+        info = stat(filename)
+        chmod(target, info.st_mode & 07777)
+        # Retention counts from the last line logged, not from compression
+        utime(target, (info.st_atime, info.st_mtime))
+        remove(filename)
+
+    def index_logfile(self, session, filename):
+        """Add the contents of a log file to the search index, replacing
+        anything previously indexed for that period.
+        Returns the number of lines indexed.
+        """
+        lines = list(self.parse_logfile(filename))
+        if not lines:
+            return 0
+
+        # Log timestamps are usually only accurate to the second
+        log_lines = LogLine.__table__
+        log_words = LogWord.__table__
+        where = ((log_lines.c.source == lines[0]['source'])
+                 & (log_lines.c.channel == lines[0]['channel'])
+                 & (log_lines.c.time >= lines[0]['time'])
+                 & (log_lines.c.time < lines[-1]['time']
+                                       + timedelta(seconds=1)))
+        session.execute(log_words.delete().where(log_words.c.line_id.in_(
+                select([log_lines.c.id], where))))
+        session.execute(log_lines.delete().where(where))
+
+        store_lines(session, lines)
+        session.commit()
+        return len(lines)
 
     @handler
     def log_handler(self, event):
@@ -214,6 +664,9 @@ class Log(Processor):
                 e = Event(response['source'], type)
                 e.source = response['source']
                 e.channel = response['target']
+                e.public = e.channel in ibid.channels.get(e.source, {}) or (
+                        event.get('public', False)
+                        and e.channel == event.get('channel'))
                 e.time = datetime.utcnow()
                 e.sender = {
                     'id': ibid.config['botname'],
@@ -223,4 +676,97 @@ class Log(Processor):
                 e.message = response['reply']
                 self.log_event(e)
 
+class SearchLogs(Processor, RPC):
+    usage = u"""grep logs [in <channel>] [from <nick>] [in the last <n> days] for <words>"""
+    features = ('logsearch',)
+
+    results = IntOption('results', u'Maximum number of lines to return', 3)
+    rpc_channels = ListOption('rpc_channels',
+            u'List of source:channel globs for channels whose logs can be '
+            u'searched over RPC', [])
+
+    def __init__(self, name):
+        super(SearchLogs, self).__init__(name)
+        RPC.__init__(self)
+
+    def setup(self):
+        super(SearchLogs, self).setup()
+        self.rpc_globs = compile_globs(self.rpc_channels)
+
+    @match(r'^(?:grep|search)\s+(?:the\s+)?logs?'
+           r'(?:\s+in\s+(\S+))?(?:\s+from\s+(\S+))?'
+           r'(?:\s+in\s+the\s+(?:last|past)\s+(\d+)\s+(hour|day|week)s?)?'
+           r'\s+for\s+(.+)$')
+    def grep(self, event, channel, nick, number, unit, terms):
+        if channel is None:
+            if not event.public:
+                event.addresponse(u'Which channel should I search?')
+                return
+            channel = event.channel
+        elif event.identity not in ibid.channels.get(event.source, {}) \
+                                              .get(channel, ()):
+            event.addresponse(u"Sorry, you can only search the logs of "
+                              u"channels you're in")
+            return
+
+        since = None
+        if number:
+            since = event.time - timedelta(**{unit + 's': int(number)})
+
+        if not tokenize(terms):
+            event.addresponse(u'I need at least one word to search for')
+            return
+
+        lines = search_logs(event.session, terms,
+                source=event.source.replace('/', '-'),
+                channel=ibid.sources[event.source].logging_name(channel)
+                                                  .replace('/', '-'),
+                nick=nick, since=since, limit=self.results)
+
+        if not lines:
+            event.addresponse(u"I couldn't find that in the %s logs", channel)
+            return
+
+        for line in lines:
+            event.addresponse(u'[%(time)s] <%(nick)s> %(message)s', {
+                'time': format_date(line.time),
+                'nick': line.nick,
+                'message': line.message,
+            })
+
+    def remote_search(self, terms, source=None, channel=None, nick=None,
+                      since=None, until=None, limit=10):
+        """Search the logs for lines containing all the words in terms.
+        since and until are UTC timestamps in ISO 8601 format.
+        RPC callers aren't authenticated, so only the channels listed in
+        rpc_channels can be searched.
+        """
+        if source is None or channel is None:
+            raise ValueError(u'A source and channel must be specified')
+        for source_re, channel_re in self.rpc_globs:
+            if source_re.match(source) and channel_re.match(channel):
+                break
+        else:
+            raise ValueError(u"The logs of %s on %s can't be searched over "
+                             u"RPC" % (channel, source))
+
+        if since:
+            since = parse_date(since).replace(tzinfo=None)
+        if until:
+            until = parse_date(until).replace(tzinfo=None)
+
+        session = ibid.databases.ibid()
+        try:
+            return [{
+                'source': line.source,
+                'channel': line.channel,
+                'time': line.time.isoformat() + 'Z',
+                'type': line.type,
+                'nick': line.nick,
+                'message': line.message,
+            } for line in search_logs(session, terms, source, channel, nick,
+                                      since, until, int(limit))]
+        finally:
+            session.close()
+
 # vi: set et sta sw=4 ts=4:
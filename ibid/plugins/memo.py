@@ -5,13 +5,15 @@ from datetime import datetime
 import logging
 from random import choice
 import re
+from threading import Lock
 
 import ibid
 from ibid.plugins import Processor, handler, match, authorise
 from ibid.compat import any
 from ibid.config import IntOption
 from ibid.db import IbidUnicodeText, Boolean, Integer, DateTime, \
-                    Table, Column, ForeignKey, relation, Base, VersionedSchema
+                    Table, Column, ForeignKey, relation, Base, VersionedSchema, \
+                    func
 from ibid.db.models import Identity, Account
 from ibid.auth import permission
 from ibid.plugins.identity import get_identities
@@ -22,7 +24,9 @@ features = {'memo': {
     'categories': ('remember', 'message',),
 }}
 
-nomemos_cache = set()
+# identity id -> number of undelivered memos for it. Loaded on first use
+pending_memos = None
+pending_lock = Lock()
 notified_overlimit_cache = set()
 
 log = logging.getLogger('plugins.memo')
@@ -140,7 +144,7 @@ class Tell(Processor):
                 memo.id, to.id, who, event.identity, event.sender['connection'],
                 memo.memo)
         event.memo = memo.id
-        nomemos_cache.clear()
+        add_pending(to.id)
         notified_overlimit_cache.discard(to.id)
 
         event.addresponse(u"%(acknowledgement)s, I'll %(action)s "
@@ -214,6 +218,7 @@ class Tell(Processor):
 
         event.session.delete(memo)
         event.session.commit()
+        remove_pending(memo.to_id)
         log.info(u'Cancelled memo %s for %s (%s) from %s (%s): %s',
                  memo.id, memo.to_id, who, event.identity,
                  event.sender['connection'], memo.memo)
@@ -230,6 +235,56 @@ class Tell(Processor):
         else:
             event.addresponse(True)
 
+def load_pending(session):
+    "Load the number of undelivered memos for each recipient"
+    global pending_memos
+    pending_lock.acquire()
+    try:
+        if pending_memos is None:
+            pending_memos = dict(session.query(Memo.to_id, func.count(Memo.id))
+                                        .filter_by(delivered=False)
+                                        .group_by(Memo.to_id).all())
+    finally:
+        pending_lock.release()
+
+def add_pending(to_id):
+    "A memo has been stored for to_id"
+    pending_lock.acquire()
+    try:
+        if pending_memos is not None:
+            pending_memos[to_id] = pending_memos.get(to_id, 0) + 1
+    finally:
+        pending_lock.release()
+
+def remove_pending(to_id):
+    "A memo for to_id has been delivered or forgotten"
+    pending_lock.acquire()
+    try:
+        if pending_memos is not None and to_id in pending_memos:
+            pending_memos[to_id] -= 1
+            if pending_memos[to_id] <= 0:
+                del pending_memos[to_id]
+    finally:
+        pending_lock.release()
+
+def has_pending(event):
+    "Does the sender have any undelivered memos?"
+    if pending_memos is None:
+        load_pending(event.session)
+    for identity in get_identities(event):
+        if identity in pending_memos:
+            return True
+    return False
+
+def clear_pending(event):
+    "The sender turned out to have no undelivered memos"
+    pending_lock.acquire()
+    try:
+        for identity in get_identities(event):
+            pending_memos.pop(identity, None)
+    finally:
+        pending_lock.release()
+
 def get_memos(event, delivered=False):
     identities = get_identities(event)
     return event.session.query(Memo) \
@@ -248,10 +303,13 @@ class Deliver(Processor):
 
     @handler
     def deliver(self, event):
-        if event.identity in nomemos_cache:
+        if not has_pending(event):
             return
 
         memos = get_memos(event)
+        if not memos:
+            clear_pending(event)
+            return
 
         if len(memos) > self.public_limit and event.public:
             if event.identity not in notified_overlimit_cache:
@@ -288,12 +346,10 @@ class Deliver(Processor):
             memo.delivered = True
             event.session.add(memo)
             event.session.commit()
+            remove_pending(memo.to_id)
             log.info(u"Delivered memo %s to %s (%s)",
                     memo.id, event.identity, event.sender['connection'])
 
-        if 'memo' not in event:
-            nomemos_cache.add(event.identity)
-
 class Notify(Processor):
     features = ('memo',)
 
@@ -309,7 +365,7 @@ class Notify(Processor):
         if event.state != 'online':
             return
 
-        if event.identity in nomemos_cache:
+        if not has_pending(event):
             return
 
         memos = get_memos(event)
@@ -330,7 +386,7 @@ class Notify(Processor):
                 { 'memo_count' : len(memos) },
                 target=event.sender['connection'])
         else:
-            nomemos_cache.add(event.identity)
+            clear_pending(event)
 
 class Messages(Processor):
     usage = u"""my messages
@@ -1,8 +1,12 @@
 # Copyright (c) 2009-2010, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from array import array
+from bisect import bisect_right
 import logging
+import os
 import re
+from threading import Lock
 import time
 
 from ibid.config import Option, IntOption
@@ -17,6 +21,133 @@ features = {'rfc': {
 cachetime = 60*60
 log = logging.getLogger("plugin.rfc")
 
+class RFCIndex(object):
+    """The parsed RFC index.
+    Records are stored in a single buffer, one per line, in order of RFC
+    number. Every whitespace-separated word is indexed, so that a term
+    appears in a record exactly when it is part of one of the record's
+    indexed words.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        stat = os.stat(filename)
+        self.version = (stat.st_mtime, stat.st_size)
+
+        f = file(filename, "rU")
+        lines = f.readlines()
+        f.close()
+
+        breaks = 0
+        strip = -1
+        for lineno, line in enumerate(lines):
+            if line.startswith(20 * "~"):
+                breaks += 1
+            elif breaks == 2 and line.startswith("000"):
+                strip = lineno
+                break
+        lines = lines[strip:]
+
+        records = {}
+        buf = ""
+        # So there's nothing left in buf:
+        lines.append("")
+        for line in lines:
+            line = line.strip()
+            if line:
+                buf += " " + line
+            elif buf:
+                number, desc = buf.strip().split(None, 1)
+                records[int(number)] = unicode(desc, encoding="ASCII")
+                buf = ""
+
+        self.numbers = sorted(records)
+        # number -> position in self.numbers
+        self.positions = dict((number, i)
+                              for i, number in enumerate(self.numbers))
+        # Offset of each record in self.text
+        self.starts = array('i')
+        text = []
+        offset = 0
+        words = {}
+        for i, number in enumerate(self.numbers):
+            record = records[number]
+            self.starts.append(offset)
+            text.append(record)
+            offset += len(record) + 1
+            for word in set(record.lower().split()):
+                words.setdefault(word, array('i')).append(i)
+        self.starts.append(offset)
+        self.text = u"\n".join(text) + u"\n"
+
+        # All the words, one per line, for substring search
+        self.vocabulary = sorted(words)
+        self.postings = [words[word] for word in self.vocabulary]
+        self.word_starts = array('i')
+        offset = 0
+        for word in self.vocabulary:
+            self.word_starts.append(offset)
+            offset += len(word) + 1
+        self.words = u"\n".join(self.vocabulary) + u"\n"
+
+    def __contains__(self, number):
+        return number in self.positions
+
+    def record(self, number):
+        i = self.positions[number]
+        return self.text[self.starts[i]:self.starts[i + 1] - 1]
+
+    def search_term(self, term):
+        "Return the positions of the records that contain term"
+        found = set()
+        term = term.lower()
+        word = self.words.find(term)
+        while word != -1:
+            i = bisect_right(self.word_starts, word) - 1
+            found.update(self.postings[i])
+            # Skip to the next word
+            if i + 1 == len(self.word_starts):
+                break
+            word = self.words.find(term, self.word_starts[i + 1])
+        return found
+
+    def search(self, terms):
+        "Return the numbers of the RFCs that contain all of terms"
+        found = None
+        for term in sorted(set(terms), key=len, reverse=True):
+            matches = self.search_term(term)
+            if found is None:
+                found = matches
+            else:
+                found &= matches
+            if not found:
+                return []
+        if found is None:
+            return list(self.numbers)
+        return [self.numbers[i] for i in sorted(found)]
+
+    def search_regex(self, term_re):
+        "Return the numbers of the RFCs that term_re.search() matches"
+        found = []
+        # Search the whole buffer, but check matches against their records
+        buffer_re = re.compile(term_re.pattern, term_re.flags | re.M)
+        pos = 0
+        while pos < len(self.text):
+            m = buffer_re.search(self.text, pos)
+            if m is None:
+                break
+            i = bisect_right(self.starts, m.start()) - 1
+            if i + 1 == len(self.starts):
+                break
+            number = self.numbers[i]
+            if term_re.search(self.record(number)):
+                found.append(number)
+            pos = self.starts[i + 1]
+        return found
+
+index = None
+index_lock = Lock()
+
 class RFCLookup(Processor):
     usage = u"""rfc <number>
     rfc [for] <search terms>
@@ -71,7 +202,7 @@ class RFCLookup(Processor):
 
         def __init__(self, number, record):
             self.number = number
-            self.record = unicode(record, encoding="ASCII")
+            self.record = record
 
             self.issued = not self.record == "Not Issued."
             self.summary = self.record
@@ -122,47 +253,29 @@ class RFCLookup(Processor):
                     if self.obsoleted:
                         self.summary += u" Obsoleted by " + u", ".join(self.obsoleted)
 
-    def _parse_rfcs(self):
+    def _index(self):
+        "Return the RFCIndex, rebuilding it if the index file has changed"
+        global index
         self._update_list()
 
-        f = file(self.indexfile, "rU")
-        lines = f.readlines()
-        f.close()
-
-        breaks = 0
-        strip = -1
-        for lineno, line in enumerate(lines):
-            if line.startswith(20 * "~"):
-                breaks += 1
-            elif breaks == 2 and line.startswith("000"):
-                strip = lineno
-                break
-        lines = lines[strip:]
-
-        rfcs = {}
-        buf = ""
-        # So there's nothing left in buf:
-        lines.append("")
-        for line in lines:
-            line = line.strip()
-            if line:
-                buf += " " + line
-            elif buf:
-                number, desc = buf.strip().split(None, 1)
-                number = int(number)
-                rfcs[number] = self.RFC(number, desc)
-                buf = ""
-
-        return rfcs
+        index_lock.acquire()
+        try:
+            stat = os.stat(self.indexfile)
+            if index is None or index.filename != self.indexfile \
+                    or index.version != (stat.st_mtime, stat.st_size):
+                index = RFCIndex(self.indexfile)
+            return index
+        finally:
+            index_lock.release()
 
     @match(r'^rfc\s+#?(\d+)$')
     def lookup(self, event, number):
-        rfcs = self._parse_rfcs()
+        rfcs = self._index()
 
         number = int(number)
         if number in rfcs:
             event.addresponse(u"%(record)s http://www.rfc-editor.org/rfc/rfc%(number)i.txt", {
-                'record': rfcs[number].record,
+                'record': rfcs.record(number),
                 'number': number,
             })
         else:
@@ -174,29 +287,27 @@ class RFCLookup(Processor):
         if terms.isdigit():
             return
 
-        rfcs = self._parse_rfcs()
+        rfcs = self._index()
 
         # Search engines:
-        pool = rfcs.itervalues()
         if len(terms) > 2 and terms[0] == terms[-1] == "/":
             try:
                 term_re = re.compile(terms[1:-1], re.I)
             except re.error:
                 event.addresponse(u"Couldn't search. Invalid regex: %s", re.message)
                 return
-            pool = [rfc for rfc in pool if term_re.search(rfc.record)]
+            pool = rfcs.search_regex(term_re)
 
         else:
-            terms = set(terms.split())
-            for term in terms:
-                pool = [rfc for rfc in pool if term.lower() in rfc.record.lower()]
+            pool = rfcs.search(terms.split())
 
         # Newer RFCs matter more:
         pool.reverse()
 
         if pool:
             results = []
-            for result in pool[:5]:
+            for number in pool[:5]:
+                result = self.RFC(number, rfcs.record(number))
                 result.parse()
                 results.append("%04i: %s" % (result.number, result.summary))
             event.addresponse(u'Found %(found)i matching RFCs. Listing %(listing)i: %(results)s', {
@@ -3,12 +3,17 @@
 
 from datetime import datetime
 import logging
+from threading import Lock
+
+import ibid
 
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
                     Table, Column, ForeignKey, UniqueConstraint, \
                     relation, IntegrityError, Base, VersionedSchema
 from ibid.db.models import Identity, Account
-from ibid.plugins import Processor, match, handler
+from ibid.config import IntOption
+from ibid.plugins import Processor, match, handler, periodic
+from ibid.plugins.identity import get_account_identities
 from ibid.utils import ago, format_date
 
 log = logging.getLogger('plugins.seen')
@@ -62,6 +67,106 @@ class Sighting(Base):
         return u'<Sighting %s %s in %s at %s: %s>' % (
                self.type, self.identity_id, self.channel, self.time, self.value)
 
+# Marks PendingSighting fields that no buffered event has set
+_unset = object()
+
+class PendingSighting(object):
+    "A sighting that hasn't been written to the database yet"
+
+    def __init__(self, identity_id, type, source):
+        self.identity_id = identity_id
+        self.type = type
+        self.source = source
+        self.channel = _unset
+        self.value = _unset
+        self.time = None
+        self.count = 0
+
+    def apply(self, sighting):
+        "Update a Sighting (or an older PendingSighting) with this one"
+        if self.channel is not _unset:
+            sighting.channel = self.channel
+        if self.value is not _unset:
+            sighting.value = self.value
+        sighting.time = self.time
+        sighting.count = (sighting.count or 0) + self.count
+
+# (identity_id, type) -> PendingSighting
+pending = {}
+pending_lock = Lock()
+
+def pending_sightings(identity_ids):
+    "Return the buffered sightings for identity_ids"
+    identity_ids = set(identity_ids)
+    pending_lock.acquire()
+    try:
+        return [sighting for sighting in pending.itervalues()
+                if sighting.identity_id in identity_ids]
+    finally:
+        pending_lock.release()
+
+def flush_sightings(session=None):
+    "Write all the buffered sightings to the database, in one transaction"
+    global pending
+    pending_lock.acquire()
+    try:
+        batch, pending = pending, {}
+    finally:
+        pending_lock.release()
+
+    if not batch:
+        return 0
+
+    own_session = session is None
+    if own_session:
+        session = ibid.databases.ibid()
+    try:
+        try:
+            try:
+                _write_sightings(session, batch)
+            except IntegrityError:
+                # Another process created some of these rows, try again
+                session.rollback()
+                log.debug(u'Race encountered writing %i sightings',
+                          len(batch))
+                _write_sightings(session, batch)
+        except:
+            session.rollback()
+            # Put the batch back, under anything that has arrived since
+            pending_lock.acquire()
+            try:
+                for key, sighting in pending.iteritems():
+                    if key in batch:
+                        sighting.apply(batch[key])
+                    else:
+                        batch[key] = sighting
+                pending = batch
+            finally:
+                pending_lock.release()
+            raise
+    finally:
+        if own_session:
+            session.close()
+
+    return len(batch)
+
+def _write_sightings(session, batch):
+    identity_ids = list(set(identity_id for identity_id, type in batch))
+    existing = {}
+    for i in xrange(0, len(identity_ids), 500):
+        for sighting in session.query(Sighting).filter(
+                Sighting.identity_id.in_(identity_ids[i:i+500])).all():
+            existing[(sighting.identity_id, sighting.type)] = sighting
+
+    for key, buffered in batch.iteritems():
+        sighting = existing.get(key)
+        if sighting is None:
+            sighting = Sighting(buffered.identity_id, buffered.type)
+        buffered.apply(sighting)
+        session.add(sighting)
+
+    session.commit()
+
 class See(Processor):
     features = ('seen',)
 
@@ -70,97 +175,141 @@ class See(Processor):
     addressed = False
     processed = True
 
+    flush_interval = IntOption('flush_interval',
+            u'Seconds between writing buffered sightings to the database', 10)
+    flush_size = IntOption('flush_size',
+            u'Number of buffered sightings that triggers a write', 500)
+
+    def shutdown(self):
+        flush_sightings()
+
     @handler
     def see(self, event):
-        sighting = event.session.query(Sighting) \
-                .filter_by(identity_id=event.identity, type=event.type).first()
-        if not sighting:
-            sighting = Sighting(event.identity, event.type)
-
-        if 'channel' in event:
-            sighting.channel = 'public' in event and event.public and event.channel or None
-        if event.type == 'message':
-            sighting.value = event.public and event.message['raw'] or None
-        elif event.type == 'state':
-            sighting.value = event.state
-        sighting.time = event.time
-        sighting.count = sighting.count + 1
-
-        event.session.add(sighting)
+        key = (event.identity, event.type)
+        pending_lock.acquire()
         try:
-            event.session.commit()
-        except IntegrityError:
-            event.session.rollback()
-            event.session.close()
-            del event['session']
-            log.debug(u'Race encountered updating seen for %s on %s',
-                    event.sender['id'], event.source)
+            sighting = pending.get(key)
+            if sighting is None:
+                sighting = pending[key] = PendingSighting(
+                        event.identity, event.type, event.source)
+
+            if 'channel' in event:
+                sighting.channel = 'public' in event and event.public and event.channel or None
+            if event.type == 'message':
+                sighting.value = event.public and event.message['raw'] or None
+            elif event.type == 'state':
+                sighting.value = event.state
+            sighting.time = event.time
+            sighting.count += 1
+
+            full = len(pending) >= self.flush_size
+        finally:
+            pending_lock.release()
+
+        if full:
+            flush_sightings(event.session)
+
+    @periodic(config_key='flush_interval', initial_delay=10)
+    def flush(self, event):
+        flush_sightings(event.session)
 
 class Seen(Processor):
-    usage = u'seen <who>'
+    usage = u'seen <who>[, <who>...] [on <source>]'
     features = ('seen',)
 
-    @match(r'^(?:have\s+you\s+)?seen\s+(\S+)(?:\s+on\s+(\S+))?$')
-    def handler(self, event, who, source):
+    @match(r'^(?:have\s+you\s+)?seen\s+(\S+(?:\s*,\s*\S+)*)(?:\s+on\s+(\S+))?$')
+    def handler(self, event, whos, source):
+        # who -> identity ids, in the order they were asked about
+        people = []
+        for who in whos.split(u','):
+            who = who.strip()
+            if not who:
+                continue
+            people.append((who, self._resolve(event, who, source)))
+
+        identity_ids = set()
+        for who, identities in people:
+            if identities is not None:
+                identity_ids.update(identities)
+        identity_ids = list(identity_ids)
 
-        account = None
+        # (identity_id, type) -> (sighting, source)
+        sightings = {}
+        for i in xrange(0, len(identity_ids), 500):
+            for sighting, identity_source in event.session.query(
+                    Sighting, Identity.source) \
+                    .join(Sighting.identity) \
+                    .filter(Sighting.identity_id.in_(identity_ids[i:i+500])) \
+                    .all():
+                sightings[(sighting.identity_id, sighting.type)] = \
+                        (sighting, identity_source)
+        for sighting in pending_sightings(identity_ids):
+            key = (sighting.identity_id, sighting.type)
+            current = Sighting(sighting.identity_id, sighting.type)
+            if key in sightings:
+                current.channel = sightings[key][0].channel
+                current.value = sightings[key][0].value
+            sighting.apply(current)
+            sightings[key] = (current, sighting.source)
+
+        for who, identities in people:
+            if identities is None:
+                event.addresponse(u"I don't know who %s is", who)
+            else:
+                event.addresponse(self._describe(event, who, identities,
+                                                 sightings))
+
+    def _resolve(self, event, who, source):
+        "Return the identity ids that who refers to, or None"
         identity = event.session.query(Identity) \
                 .filter_by(source=(source or event.source), identity=who) \
                 .first()
-        if identity and identity.account and not source:
-            account = identity.account
-
-        if not identity and not source:
-            account = event.session.query(Account).filter_by(username=who) \
-                    .first()
-
-        if not identity and not account:
-            event.addresponse(u"I don't know who %s is", who)
-            return
-
-        messages = []
-        states = []
-        if account:
-            for identity in account.identities:
-                for sighting in event.session.query(Sighting) \
-                        .filter_by(identity_id=identity.id).all():
-                    if sighting.type == 'message':
-                        messages.append(sighting)
-                    else:
-                        states.append(sighting)
-        else:
-            for sighting in event.session.query(Sighting) \
-                    .filter_by(identity_id=identity.id).all():
-                if sighting.type == 'message':
-                    messages.append(sighting)
-                else:
-                    states.append(sighting)
-
-        if len(messages) == 0 and len(states) == 0:
-            event.addresponse(u"I haven't seen %s", who)
-            return
-
-        messages.sort(key=lambda x: x.time, reverse=True)
-        states.sort(key=lambda x: x.time, reverse=True)
+        if identity and identity.account_id and not source:
+            return get_account_identities(event.session, identity.account_id)
+        if identity:
+            return (identity.id,)
+
+        if not source:
+            account = event.session.query(Account) \
+                    .filter_by(username=who).first()
+            if account:
+                return get_account_identities(event.session, account.id)
+
+        return None
+
+    def _describe(self, event, who, identities, sightings):
+        message = state = None
+        for identity_id in identities:
+            for type in (u'message', u'state'):
+                sighting = sightings.get((identity_id, type))
+                if sighting is None:
+                    continue
+                if type == u'message':
+                    if message is None or sighting[0].time > message[0].time:
+                        message = sighting
+                elif state is None or sighting[0].time > state[0].time:
+                    state = sighting
+
+        if message is None and state is None:
+            return u"I haven't seen %s" % who
 
         reply = u''
-        if len(messages) > 0:
-            sighting = messages[0]
+        if message is not None:
+            sighting, source = message
             delta = event.time - sighting.time
             reply = u'%s was last seen %s ago in %s on %s [%s]' %(
                     who, ago(delta), sighting.channel or 'private',
-                    sighting.identity.source, format_date(sighting.time))
+                    source, format_date(sighting.time))
 
-        if len(states) > 0:
-            sighting = states[0]
+        if state is not None:
+            sighting, source = state
             if reply:
                 reply += u', and'
             else:
                 reply = who
             reply += u' has been %s on %s since %s' % (
-                    sighting.value, sighting.identity.source,
-                    format_date(sighting.time))
+                    sighting.value, source, format_date(sighting.time))
 
-        event.addresponse(reply)
+        return reply
 
 # vi: set et sta sw=4 ts=4:
@@ -1,20 +1,27 @@
 # Copyright (c) 2009-2010, Michael Gorven, Stefano Rivera
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
+from array import array
+from bisect import bisect_right
+import logging
 import os
 import re
 from subprocess import Popen, PIPE
+from threading import Lock
+from time import time
 from urllib import quote
 from urllib2 import HTTPError
 
 from ibid.compat import defaultdict
 from ibid.plugins import Processor, match
-from ibid.config import DictOption, Option
+from ibid.config import DictOption, IntOption, Option
 from ibid.utils import cacheable_download, file_in_path, generic_webservice, \
                        human_join, json_webservice, plural, unicode_output
 
 features = {}
 
+log = logging.getLogger('plugins.sysadmin')
+
 features['aptitude'] = {
     'description': u'Searches for packages',
     'categories': ('sysadmin', 'lookup',),
@@ -362,18 +369,163 @@ features['mac'] = {
     'description': u'Finds the organization owning the specific MAC address.',
     'categories': ('sysadmin', 'lookup',),
 }
+oui_re = re.compile(r'^\s*([0-9A-F]{6})(?:-([0-9A-F]{6}))?\s+\(base 16\)\s*(.*?)\s*$')
+oui_hex_re = re.compile(r'^\s*([0-9A-F]{2})-([0-9A-F]{2})-([0-9A-F]{2})\s+\(hex\)')
+
+class OUITable(object):
+    """IEEE MAC address assignments, compiled from the registry files.
+    MA-L (24-bit) prefixes are kept in a sorted array, and the smaller MA-M
+    (28-bit) and MA-S (36-bit) blocks in sorted arrays of address ranges.
+    Organisation names are stored in a single string, indexed by offset.
+    """
+
+    def __init__(self, filenames):
+        self.version = self.file_version(filenames)
+        names = []
+        self.name_offsets = array('L', [0])
+
+        def add_name(name):
+            names.append(name)
+            self.name_offsets.append(self.name_offsets[-1] + len(name))
+            return len(names) - 1
+
+        large = []
+        blocks = []
+        for filename in filenames:
+            f = file(filename, 'rU')
+            try:
+                oui = None
+                for line in f:
+                    m = oui_hex_re.match(line)
+                    if m:
+                        oui = int(''.join(m.groups()), 16)
+                        continue
+                    m = oui_re.match(line)
+                    if not m:
+                        continue
+                    low, high, name = m.groups()
+                    name = add_name(name.decode('utf8').title())
+                    if high is None:
+                        large.append((int(low, 16), name))
+                    elif oui is not None:
+                        low, high = int(low, 16), int(high, 16)
+                        # The number of bits fixed by the assignment
+                        bits, size = 48, high - low
+                        while size:
+                            bits -= 1
+                            size >>= 1
+                        blocks.append(((oui << 24) | low, (oui << 24) | high,
+                                       bits, name))
+            finally:
+                f.close()
+
+        self.names = u''.join(names)
+
+        # Where a prefix is listed twice, the first listing wins
+        large.sort()
+        large = [entry for i, entry in enumerate(large)
+                 if i == 0 or large[i - 1][0] != entry[0]]
+        self.prefixes = array('L', [prefix for prefix, name in large])
+        self.prefix_names = array('L', [name for prefix, name in large])
+
+        # 48-bit addresses don't fit in every array type, so store them in
+        # 24-bit halves
+        blocks.sort()
+        self.block_starts = [start for start, end, bits, name in blocks]
+        self.block_ends = array('L', [end & 0xFFFFFF for start, end, bits, name
+                                      in blocks])
+        self.block_bits = array('B', [bits for start, end, bits, name
+                                      in blocks])
+        self.block_names = array('L', [name for start, end, bits, name
+                                       in blocks])
+
+    def file_version(filenames):
+        versions = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            versions.append((stat.st_mtime, stat.st_size))
+        return versions
+    file_version = staticmethod(file_version)
+
+    def name(self, index):
+        return self.names[self.name_offsets[index]:self.name_offsets[index + 1]]
+
+    def lookup(self, digits):
+        """Return the organisation owning the address given as a string of
+        hex digits, or None.
+        MA-M and MA-S blocks are only matched if enough digits are given.
+        """
+        address = int(digits.ljust(12, '0')[:12], 16)
+
+        i = bisect_right(self.block_starts, address) - 1
+        if i >= 0 and address >> 24 == self.block_starts[i] >> 24 \
+                and address & 0xFFFFFF <= self.block_ends[i] \
+                and len(digits) * 4 >= self.block_bits[i]:
+            return self.name(self.block_names[i])
+
+        i = bisect_right(self.prefixes, address >> 24) - 1
+        if i >= 0 and self.prefixes[i] == address >> 24:
+            return self.name(self.prefix_names[i])
+        return None
+
+oui_table = None
+oui_lock = Lock()
+
 class Mac(Processor):
     usage = u'mac <address>'
     features = ('mac',)
 
+    oui_url = Option('oui_url', 'URL of the IEEE MA-L (OUI) registry',
+                     'http://standards.ieee.org/regauth/oui/oui.txt')
+    mam_url = Option('mam_url', 'URL of the IEEE MA-M registry',
+                     'http://standards-oui.ieee.org/oui28/mam.txt')
+    mas_url = Option('mas_url', 'URL of the IEEE MA-S registry',
+                     'http://standards-oui.ieee.org/oui36/oui36.txt')
+
+    cachetime = IntOption('cachetime',
+            'Time to cache the registries for (in seconds)', 86400)
+    filenames = None
+    last_checked = 0
+
+    def _update_files(self):
+        """Check the registries for changes every cachetime seconds.
+        Returns True if they were checked.
+        """
+        if self.filenames and time() - self.last_checked <= self.cachetime:
+            return False
+
+        filenames = [cacheable_download(self.oui_url, 'sysadmin/oui.txt')]
+        for url, cachefile in ((self.mam_url, 'sysadmin/mam.txt'),
+                               (self.mas_url, 'sysadmin/oui36.txt')):
+            if not url:
+                continue
+            try:
+                filenames.append(cacheable_download(url, cachefile))
+            except Exception, e:
+                log.warning(u"Couldn't download %s: %s", url, unicode(e))
+        self.filenames = filenames
+        self.last_checked = time()
+        return True
+
+    def _table(self):
+        "Return the OUITable, rebuilding it if the registries have changed"
+        global oui_table
+        checked = self._update_files()
+
+        oui_lock.acquire()
+        try:
+            if oui_table is None or (checked and oui_table.version
+                    != OUITable.file_version(self.filenames)):
+                oui_table = OUITable(self.filenames)
+            return oui_table
+        finally:
+            oui_lock.release()
+
     @match(r'^((?:mac|oui|ether(?:net)?(?:\s*code)?)\s+)?((?:(?:[0-9a-f]{2}(?(1)[:-]?|:))){2,5}[0-9a-f]{2})$')
     def lookup_mac(self, event, _, mac):
-        oui = mac.replace('-', '').replace(':', '').upper()[:6]
-        ouis = open(cacheable_download('http://standards.ieee.org/regauth/oui/oui.txt', 'sysadmin/oui.txt'))
-        match = re.search(r'^\s*%s\s+\(base 16\)\s+(.+?)$' % oui, ouis.read(), re.MULTILINE)
-        ouis.close()
-        if match:
-            name = match.group(1).decode('utf8').title()
+        digits = mac.replace('-', '').replace(':', '').upper()
+        name = self._table().lookup(digits)
+        if name is not None:
             event.addresponse(u"That belongs to %s", name)
         else:
             event.addresponse(u"I don't know who that belongs to")
@@ -3,17 +3,22 @@
 
 from datetime import datetime
 from httplib import BadStatusLine
+from Queue import Queue, Full
+from threading import Thread
+from time import sleep, time
 from urllib import urlencode
 from urllib2 import build_opener, HTTPError, HTTPBasicAuthHandler
+from urlparse import urlparse
 import logging
 import re
 
 import ibid
 from ibid.plugins import Processor, handler
-from ibid.config import Option
+from ibid.config import Option, IntOption, FloatOption
 from ibid.db import IbidUnicode, IbidUnicodeText, Integer, DateTime, \
                     Table, Column, ForeignKey, Base, VersionedSchema
-from ibid.utils import url_regex
+from ibid.utils import URLPattern
+from ibid.utils.cache import LRUCache
 from ibid.utils.html import get_html_parse_tree
 
 log = logging.getLogger('plugins.urlgrab')
@@ -51,6 +56,81 @@ class URL(Base):
         self.identity_id = identity_id
         self.time = datetime.utcnow()
 
+class TitleFetcher(Thread):
+    """Looks up the titles of URLs in the background, and hands them to a
+    callback. Requests to a single host are spaced at least host_interval
+    seconds apart, and titles are cached for title_ttl seconds.
+    """
+
+    def __init__(self, queue_size=100):
+        Thread.__init__(self, name='plugins.urlgrab.fetcher')
+        self.setDaemon(True)
+        self.queue = Queue(queue_size)
+        self.titles = LRUCache(1000)
+        self.last_request = LRUCache(1000)
+        self.host_interval = 2.0
+        self.max_size = 65536
+        self.running = True
+
+    def configure(self, host_interval, max_size, title_ttl):
+        self.host_interval = host_interval
+        self.max_size = max_size
+        self.titles.ttl = title_ttl
+
+    def fetch(self, url, callback, *args):
+        """Queue url, and call callback(url, title, *args) once its title is
+        known. Returns False if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(('fetch', (url, callback, args)))
+        except Full:
+            return False
+        return True
+
+    def stop(self, timeout=None):
+        "Stop after the current URL, discarding the rest of the queue"
+        self.running = False
+        try:
+            self.queue.put_nowait(('stop', None))
+        except Full:
+            pass
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            command, args = self.queue.get()
+            if command == 'stop' or not self.running:
+                return
+            url, callback, args = args
+            try:
+                callback(url, self.get_title(url), *args)
+            except:
+                log.exception(u'Error processing URL %s', url)
+
+    def get_title(self, url):
+        "Gets the title of a page"
+        title = self.titles.get(url)
+        if title is not None:
+            return title
+
+        host = urlparse(url)[1].lower()
+        wait = self.last_request.get(host, 0) + self.host_interval - time()
+        if wait > 0:
+            sleep(wait)
+        self.last_request[host] = time()
+
+        try:
+            headers = {'User-Agent': 'Mozilla/5.0'}
+            etree = get_html_parse_tree(url, None, headers, 'etree',
+                                        max_size=self.max_size)
+            title = etree.findtext('head/title') or url
+        except Exception, e:
+            log.debug(u"Error determining title for %s: %s", url, unicode(e))
+            return url
+
+        self.titles[url] = title
+        return title
+
 class Grab(Processor):
     addressed = False
     processed = True
@@ -59,13 +139,47 @@ class Grab(Processor):
     password  = Option('password', 'Password for URL Posting')
     service   = Option('service', 'URL Posting Service (delicious/faves)',
                        'delicious')
+    queue_size = IntOption('queue_size',
+        'Maximum number of URLs waiting to be posted', 100)
+    repost_interval = IntOption('repost_interval',
+        'Time during which a URL is only posted once (in seconds)', 3600)
+    host_interval = FloatOption('host_interval',
+        'Minimum time between title lookups on one host (in seconds)', 2.0)
+    max_title_size = IntOption('max_title_size',
+        'Maximum number of bytes to download when looking up a title', 65536)
+    title_ttl = IntOption('title_ttl',
+        'Time to cache page titles for (in seconds)', 86400)
+
+    fetcher = None
+    recent = None
 
     def setup(self):
-        self.grab.im_func.pattern = re.compile((
-            r'(?:[^@./]\b(?!\.)|\A)('       # Match a boundary, but not on an e-mail address
-            + url_regex() +
-            r')[\[>)\]"\'.,;:]*(?:\s|\Z)'   # End boundary
-        ), re.I | re.DOTALL)
+        super(Grab, self).setup()
+        self.grab.im_func.pattern = URLPattern(
+            r'(?:[^@./]\b(?!\.)|\A)(',      # Match a boundary, but not on an e-mail address
+            r')[\[>)\]"\'.,;:]*(?:\s|\Z)',  # End boundary
+            re.I | re.DOTALL)
+
+        if self.recent is None:
+            self.recent = LRUCache(1000)
+        self.recent.ttl = self.repost_interval
+
+        if self.service and self.username:
+            if self.fetcher is not None and \
+                    self.fetcher.queue.maxsize != self.queue_size:
+                self.shutdown()
+            if self.fetcher is None or not self.fetcher.isAlive():
+                self.fetcher = TitleFetcher(self.queue_size)
+                self.fetcher.start()
+            self.fetcher.configure(self.host_interval, self.max_title_size,
+                                   self.title_ttl)
+        else:
+            self.shutdown()
+
+    def shutdown(self):
+        if self.fetcher is not None:
+            self.fetcher.stop(5)
+            self.fetcher = None
 
     @handler
     def grab(self, event, url):
@@ -78,13 +192,14 @@ class Grab(Processor):
         u = URL(url, event.channel, event.identity)
         event.session.add(u)
 
-        if self.service and self.username:
-            self._post_url(event, url)
+        if self.fetcher is not None:
+            self._queue_url(event, url)
 
-    def _post_url(self, event, url=None):
-        "Posts a URL to delicious.com"
+    def _queue_url(self, event, url):
+        "Queues a URL to be posted to delicious.com"
 
-        title = self._get_title(url)
+        if url in self.recent:
+            return
 
         con_re = re.compile(r'!n=|!')
         connection_body = con_re.split(event.sender['connection'])
@@ -108,12 +223,24 @@ class Grab(Processor):
 
         data = {
             'url' : url.encode('utf-8'),
-            'description' : title.encode('utf-8'),
             'tags' : tags.encode('utf-8'),
             'replace' : 'yes',
             'dt' : event.time.strftime('%Y-%m-%dT%H:%M:%SZ'),
             'extended' : event.message['raw'].encode('utf-8'),
             }
+        context = (event.channel, event.source, event.account, event.identity,
+                   event.sender['connection'])
+
+        if self.fetcher.fetch(url, self._post_url, data, context):
+            self.recent[url] = True
+        else:
+            log.warning(u"Too many URLs waiting to be posted, dropping '%s'",
+                        url)
+
+    def _post_url(self, url, title, data, context):
+        "Posts a URL to delicious.com"
+
+        data['description'] = title.encode('utf-8')
 
         if self.service.lower() == 'delicious':
             service = ('del.icio.us API', 'https://api.del.icio.us')
@@ -133,10 +260,7 @@ class Grab(Processor):
             resp = opener.open(posturl).read()
             if 'done' in resp:
                 log.debug(u"Posted url '%s' to %s, posted in %s on %s "
-                          u"by %s/%i (%s)",
-                          url, self.service, event.channel, event.source,
-                          event.account, event.identity,
-                          event.sender['connection'])
+                          u"by %s/%i (%s)", url, self.service, *context)
             else:
                 log.error(u"Error posting url '%s' to %s: %s",
                           url, self.service, resp)
@@ -148,15 +272,4 @@ class Grab(Processor):
             log.error(u"Error posting url '%s' to %s: %s",
                       url, self.service, unicode(e))
 
-    def _get_title(self, url):
-        "Gets the title of a page"
-        try:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            etree = get_html_parse_tree(url, None, headers, 'etree')
-            title = etree.findtext('head/title')
-            return title or url
-        except Exception, e:
-            log.debug(u"Error determining title for %s: %s", url, unicode(e))
-            return url
-
 # vi: set et sta sw=4 ts=4:
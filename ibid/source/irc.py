@@ -3,17 +3,16 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 from fnmatch import fnmatch
-from time import sleep
 import logging
-from threading import Lock
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.words.protocols import irc
 from twisted.internet import protocol, ssl
 from twisted.application import internet
 from sqlalchemy import or_
 
 import ibid
+from ibid.auth import AuthenticationPending
 from ibid.config import Option, IntOption, BoolOption, FloatOption, ListOption
 from ibid.db.models import Credential
 from ibid.source import IbidSourceFactory
@@ -38,7 +37,9 @@ class Ircbot(irc.IRCClient):
         self.factory.resetDelay()
         self.factory.proto = self
         self.auth_callbacks = {}
+        self.auth_timeouts = {}
         self.mode_prefixes = '@+'
+        self._names = {}
         self._ping_deferred = reactor.callLater(self.factory.ping_interval, self._idle_ping)
         self.factory.log.info(u"Connected")
 
@@ -49,6 +50,9 @@ class Ircbot(irc.IRCClient):
         event.status = u'disconnected'
         ibid.dispatcher.dispatch(event)
 
+        for nick in self.auth_callbacks.keys():
+            self.do_auth_callback(nick, False)
+
         irc.IRCClient.connectionLost(self, reason)
 
     def _idle_ping(self):
@@ -238,19 +242,31 @@ class Ircbot(irc.IRCClient):
         event.status = u'left'
         ibid.dispatcher.dispatch(event)
 
-    def authenticate(self, nick, callback):
+    def authenticate(self, nick):
+        """Return a Deferred that fires with True if nick has identified to
+        NickServ. Concurrent requests for a nick share a single WHOIS.
+        """
+        nick = nick.encode('utf-8')
+        deferred = defer.Deferred()
         if nick in self.auth_callbacks:
-            self.auth_callbacks[nick].append(callback)
+            self.auth_callbacks[nick].append(deferred)
         else:
-            self.auth_callbacks[nick] = [callback]
-            self.sendLine('WHOIS %s' % nick.encode('utf-8'))
+            self.auth_callbacks[nick] = [deferred]
+            self.auth_timeouts[nick] = reactor.callLater(
+                    self.factory.nickserv_timeout,
+                    self.do_auth_callback, nick, False)
+            self.sendLine('WHOIS %s' % nick)
+        return deferred
 
     def do_auth_callback(self, nick, result):
         if nick in self.auth_callbacks:
-            self.factory.log.debug(u"Authentication result for %s: %s", nick, result)
-            for callback in self.auth_callbacks[nick]:
-                callback(result)
-            del self.auth_callbacks[nick]
+            self.factory.log.debug(u"Authentication result for %s: %s",
+                                   nick.decode('utf-8', 'replace'), result)
+            timeout = self.auth_timeouts.pop(nick)
+            if timeout.active():
+                timeout.cancel()
+            for deferred in self.auth_callbacks.pop(nick):
+                deferred.callback(result)
 
     def irc_unknown(self, prefix, command, params):
         if command == '307' and len(params) == 3 and params[2] == 'is a registered nick':
@@ -283,12 +299,24 @@ class Ircbot(irc.IRCClient):
                 self.mode_prefixes = option.split(')', 1)[1]
 
     def irc_RPL_NAMREPLY(self, prefix, params):
-        channel = params[2]
+        names = self._names.setdefault(params[2], [])
         for user in params[3].split():
             if user[0] in self.mode_prefixes:
                 user = user[1:]
             if user != self.nickname:
-                self.userJoined(user, channel)
+                names.append(unicode(user, 'utf-8', 'replace'))
+
+    def irc_RPL_ENDOFNAMES(self, prefix, params):
+        # Announce the whole channel at once, rather than a state event per
+        # user
+        names = self._names.pop(params[1], [])
+        event = Event(self.factory.name, u'source')
+        event.status = u'members'
+        event.channel = unicode(params[1], 'utf-8', 'replace')
+        event.members = [{'connection': nick, 'id': nick, 'nick': nick}
+                         for nick in names]
+        self.factory.log.debug(u'%i users in %s', len(names), event.channel)
+        ibid.dispatcher.dispatch(event)
 
     def ctcpQuery_VERSION(self, user, channel, data):
         nick = user.split("!")[0]
@@ -323,15 +351,14 @@ class SourceFactory(protocol.ReconnectingClientFactory, IbidSourceFactory):
     channels = ListOption('channels', 'Channels to autojoin', [])
     ping_interval = FloatOption('ping_interval', 'Seconds idle before sending a PING', 60)
     pong_timeout = FloatOption('pong_timeout', 'Seconds to wait for PONG', 300)
+    nickserv_timeout = FloatOption('nickserv_timeout',
+            'Seconds to wait for a WHOIS reply when authenticating', 15)
     # ReconnectingClient uses this:
     maxDelay = IntOption('max_delay', 'Max seconds to wait inbetween reconnects', 900)
     factor = FloatOption('delay_factor', 'Factor to multiply delay inbetween reconnects by', 2)
 
     def __init__(self, name):
         IbidSourceFactory.__init__(self, name)
-        self._auth = {}
-        self._auth_ticket = 0
-        self._auth_ticket_lock = Lock()
         self.log = logging.getLogger('source.%s' % self.name)
 
     def setServiceParent(self, service):
@@ -407,27 +434,10 @@ class SourceFactory(protocol.ReconnectingClientFactory, IbidSourceFactory):
                 return True
 
     def auth_nickserv(self, event, credential):
-        self._auth_ticket_lock.acquire()
-        self._auth_ticket += 1
-        ticket = self._auth_ticket
-        self._auth_ticket_lock.release()
-
-        def callback(result):
-            self._auth[ticket] = result
-
-        reactor.callFromThread(self.proto.authenticate, event.sender['nick'],
-                               callback)
-        # We block in the plugin thread for up to this long, waiting for
-        # NickServ to reply
-        wait = 15
-        for i in xrange(wait * 10):
-            if ticket in self._auth:
-                break
-            sleep(0.1)
-
-        if ticket in self._auth:
-            result = self._auth[ticket]
-            del self._auth[ticket]
-            return result
+        # Ircbot.authenticate shares one WHOIS between concurrent lookups
+        # for a nick. Successes are cached by Auth.authenticate. The
+        # dispatcher frees the worker thread while the WHOIS is pending.
+        raise AuthenticationPending(self.proto.authenticate,
+                                    event.sender['nick'])
 
 # vi: set et sta sw=4 ts=4:
@@ -29,6 +29,9 @@ class JabberBot(xmppim.MessageProtocol, xmppim.PresenceClientProtocol, xmppim.Ro
         xmppim.MessageProtocol.__init__(self)
         self.rooms = []
         self.room_users = {}
+        # Occupants of rooms we are joining, announced together once the
+        # room sends our own presence
+        self.joining = {}
 
     def connectionInitialized(self):
         self.parent.log.info(u"Connected")
@@ -60,11 +63,18 @@ class JabberBot(xmppim.MessageProtocol, xmppim.PresenceClientProtocol, xmppim.Ro
         event = Event(self.name, u'state')
         event.state = state
         if entity.userhost().lower() in self.rooms:
+            room = entity.userhost().lower()
             nick = entity.full().split('/')[1]
             event.channel = entity.userhost()
             if nick == self.parent.nick:
                 event.type = u'connection'
                 event.status = state == u'online' and u'joined' or u'left'
+                if state == u'online' and room in self.joining:
+                    members = Event(self.name, u'source')
+                    members.status = u'members'
+                    members.channel = event.channel
+                    members.members = self.joining.pop(room)
+                    ibid.dispatcher.dispatch(members)
             else:
                 if realjid:
                     if state == u'online':
@@ -79,6 +89,9 @@ class JabberBot(xmppim.MessageProtocol, xmppim.PresenceClientProtocol, xmppim.Ro
                     event.sender['id'] = event.sender['connection']
                 event.sender['nick'] = nick
                 event.public = True
+                if state == u'online' and room in self.joining:
+                    self.joining[room].append(event.sender)
+                    return
         else:
             event.sender['connection'] = entity.full()
             event.sender['id'] = event.sender['connection'].split('/')[0]
@@ -199,6 +212,7 @@ class JabberBot(xmppim.MessageProtocol, xmppim.PresenceClientProtocol, xmppim.Ro
         presence = xmppim.AvailablePresence(to=jid)
         self.xmlstream.send(presence)
         self.rooms.append(room.lower())
+        self.joining[room.lower()] = []
 
     def leave(self, room):
         self.parent.log.info(u"Leaving %s", room)
@@ -206,6 +220,7 @@ class JabberBot(xmppim.MessageProtocol, xmppim.PresenceClientProtocol, xmppim.Ro
         presence = xmppim.UnavailablePresence(to=jid)
         self.xmlstream.send(presence)
         self.rooms.remove(room.lower())
+        self.joining.pop(room.lower(), None)
 
 
 class IbidXMPPClientConnector(client.XMPPClientConnector):
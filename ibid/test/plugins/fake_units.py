@@ -0,0 +1,91 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""A stand-in for GNU units, for testing the units plugin.
+It knows a handful of units, and writes its prompts through stdio without
+flushing, as units does. Giving it the unit "hang" makes it stop
+responding.
+"""
+
+import os
+import sys
+import time
+
+units = {
+    'm': ('length', 1.0),
+    'foot': ('length', 0.3048),
+    'inch': ('length', 0.0254),
+    'kg': ('mass', 1.0),
+}
+
+def parse(text):
+    "Return (dimension, value), or None for an unknown unit"
+    words = text.split()
+    value = 1.0
+    if len(words) == 2:
+        try:
+            value = float(words[0])
+        except ValueError:
+            return None
+        words = words[1:]
+    if len(words) != 1 or words[0] not in units:
+        return None
+    dimension, factor = units[words[0]]
+    return dimension, value * factor
+
+def convert(have, want):
+    "Return (exit status, output) for converting have to want"
+    frm, to = parse(have), parse(want)
+    if frm is None:
+        return 1, "Unknown unit '%s'\n" % have
+    if to is None:
+        return 1, "Unknown unit '%s'\n" % want
+    if frm[0] != to[0]:
+        return 1, 'conformability error\n\t%s = %g %s\n\t%s = %g %s\n' % (
+                have, frm[1], frm[0], want, to[1], to[0])
+    return 0, '\t%s = %g %s\n\t%s = (1 / %g) %s\n' % (
+            have, frm[1] / to[1], want, have, to[1] / frm[1], want)
+
+def readline():
+    line = sys.stdin.readline()
+    if not line:
+        sys.exit(0)
+    line = line.strip()
+    if line == 'hang':
+        time.sleep(3600)
+    return line
+
+def main():
+    if os.environ.get('PYTHONUNBUFFERED'):
+        # Buffer stdout the way C stdio does
+        del os.environ['PYTHONUNBUFFERED']
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    args = [arg for arg in sys.argv[1:] if arg not in ('--verbose', '--')]
+    if args:
+        code, output = convert(*args)
+        sys.stdout.write(output)
+        sys.exit(code)
+
+    sys.stdout.write('%i units, 0 prefixes\n\n' % len(units))
+    while True:
+        sys.stdout.write('You have: ')
+        have = readline()
+        if parse(have) is None:
+            sys.stdout.write("Unknown unit '%s'\n" % have)
+            continue
+        while True:
+            sys.stdout.write('You want: ')
+            want = readline()
+            if not want:
+                sys.stdout.write('\tDefinition: %s\n' % have)
+                break
+            code, output = convert(have, want)
+            sys.stdout.write(output)
+            if not output.startswith('Unknown unit'):
+                break
+
+if __name__ == '__main__':
+    main()
+
+# vi: set et sta sw=4 ts=4:
@@ -2,8 +2,13 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import logging
+import os
+import sys
+
+from twisted.trial import unittest
 
 import ibid.test
+from ibid.utils import file_in_path
 
 class UnihanTest(ibid.test.PluginTestCase):
     load = ['conversions']
@@ -60,3 +65,66 @@ class CurrencyConversionTest(ibid.test.PluginTestCase):
                 r'1 EUR \(.+\) = [0-9.]+ EGP \(.+\) .* Bid: [0-9.]+')
         self.assertResponseMatches(u'exchange 1 Virgin Islands for .tv',
                 r'1 USD \(.+\) = [0-9.]+ AUD \(.+\) .* Bid: [0-9.]+')
+
+class UnitsPoolTest(ibid.test.TestCase):
+    timeout = 1.0
+
+    def setUp(self):
+        super(UnitsPoolTest, self).setUp()
+        if not file_in_path('stdbuf'):
+            raise unittest.SkipTest('stdbuf is not available')
+        from ibid.plugins import conversions
+        self.conversions = conversions
+        self.command = [sys.executable,
+                os.path.join(os.path.dirname(__file__), 'fake_units.py'),
+                '--verbose']
+        self.pool = conversions.UnitsPool(['stdbuf', '-o0'] + self.command,
+                                          1, self.timeout)
+
+    def tearDown(self):
+        self.pool.close()
+        super(UnitsPoolTest, self).tearDown()
+
+    def test_convert(self):
+        self.assertEqual(self.pool.convert(u'2 foot', u'inch'),
+                (0, '\t2 foot = 24 inch\n\t2 foot = (1 / 0.0416667) inch\n'))
+        self.assertEqual(len(self.pool.idle), 1)
+
+    def test_unknown_have(self):
+        self.assertEqual(self.pool.convert(u'frob', u'm'),
+                         (1, "Unknown unit 'frob'\n"))
+        self.assertEqual(self.pool.convert(u'm', u'foot')[0], 0)
+
+    def test_unknown_want(self):
+        self.assertEqual(self.pool.convert(u'm', u'frob'),
+                         (1, "Unknown unit 'frob'\n"))
+        self.assertEqual(self.pool.convert(u'm', u'foot')[0], 0)
+
+    def test_conformability_error(self):
+        code, output = self.pool.convert(u'm', u'kg')
+        self.assertEqual(code, 1)
+        self.assertTrue(output.startswith('conformability error\n'))
+        self.assertEqual(self.pool.convert(u'm', u'foot')[0], 0)
+
+    def test_timeout(self):
+        self.assertRaises(self.conversions.UnitsError,
+                          self.pool.convert, u'hang', u'm')
+        self.assertEqual(self.pool.idle, [])
+        self.assertEqual(self.pool.convert(u'm', u'foot')[0], 0)
+
+    def test_commands(self):
+        for frm, to in ((u'_', u'm'), (u'2 _', u'foot'), (u'm', u'_'),
+                        (u'help m', u'foot'), (u'search foot', u'm'),
+                        (u'quit', u'm'), (u'm', u'exit'), (u'm', u'?'),
+                        (u'm', u' '), (u'm\nquit', u'm')):
+            self.assertFalse(self.pool.accepts(frm, to), (frm, to))
+        self.assertTrue(self.pool.accepts(u'2 foot', u'inch'))
+        self.assertTrue(self.pool.accepts(u'US_survey_foot', u'm'))
+
+    def test_unflushed_prompts(self):
+        "Without stdbuf, the prompts don't arrive and the pool gives up"
+        pool = self.conversions.UnitsPool(self.command, 1, self.timeout)
+        self.assertRaises(self.conversions.UnitsError,
+                          pool.convert, u'm', u'foot')
+        self.assertFalse(pool.accepts(u'm', u'foot'))
+        pool.close()
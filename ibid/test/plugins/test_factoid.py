@@ -4,7 +4,9 @@
 
 import re
 
-from ibid.test import PluginTestCase
+from ibid.event import Event
+from ibid.test import PluginTestCase, TestCase
+from ibid.plugins import factoid
 
 class FactoidTest(PluginTestCase):
     load = ['factoid']
@@ -133,3 +135,95 @@ class FactoidTest(PluginTestCase):
         self.assertResponseMatches('. is foo', '.*empty')
         self.failIfResponseMatches('', '.*foo')
         self.failIfResponseMatches('.', '.*foo')
+
+class StaticFactoidTest(TestCase):
+    def fired(self, matchers, message):
+        for regex, owners in matchers:
+            match = regex.search(message)
+            if match:
+                return owners.get(match.lastgroup, owners.get(None))
+
+    def test_defaults(self):
+        matchers = factoid.compile_static(factoid.static_default)
+        self.assertEqual(self.fired(matchers, u'hello there'), 'greet')
+        self.assertEqual(self.fired(matchers, u'botsnack'), 'reward')
+        self.assertEqual(self.fired(matchers, u'  ta '), 'thanks')
+        self.assertEqual(self.fired(matchers, u'You ROCK'), 'praise')
+        self.assertEqual(self.fired(matchers, u'nothing to see'), None)
+
+    def test_extras(self):
+        matchers = factoid.compile_static({
+            'single': {'matches': r'^ping$', 'responses': [u'pong']},
+            'backref': {'matches': [r'\b(\w+) \1\b'], 'responses': [u'echo']},
+            'broken': {'matches': [r'foo('], 'responses': [u'never']},
+        })
+        self.assertEqual(self.fired(matchers, u'PING'), 'single')
+        self.assertEqual(self.fired(matchers, u'that that'), 'backref')
+        self.assertEqual(self.fired(matchers, u'this that'), None)
+        self.assertEqual(self.fired(matchers, u'foo('), None)
+
+    def test_group_limit(self):
+        matchers = factoid.compile_static(dict(
+            ('f%i' % i, {'matches': [r'\b(x%i)(y)\b' % i], 'responses': []})
+            for i in range(100)))
+        self.assertTrue(len(matchers) > 1)
+        self.assertEqual(self.fired(matchers, u'a x42y b'), 'f42')
+
+class FactoidTemplateTest(TestCase):
+    def setUp(self):
+        super(FactoidTemplateTest, self).setUp()
+        self.event = Event(u'fakesource', u'message')
+        self.event.sender = {'nick': u'joe'}
+        self.event.channel = u'#chan'
+
+    def expand(self, value, args=()):
+        return factoid.FactoidTemplate(value).expand(self.event, args)
+
+    def test_plain(self):
+        self.assertEqual(self.expand(u'no variables here'), u'no variables here')
+        self.assertEqual(self.expand(u'costs $5 in $'), u'costs $5 in $')
+
+    def test_variables(self):
+        self.assertEqual(self.expand(u'hi $who in $channel on $source'),
+                         u'hi joe in #chan on fakesource')
+        self.assertEqual(self.expand(u'$whom'), u'joem')
+        self.assertTrue(re.match(r'^\d{2} \d+ [A-Z][a-z]{2}$',
+                                 self.expand(u'$month2 $month1 $mon')))
+
+    def test_args(self):
+        self.assertEqual(self.expand(u'$2 then $1', (u'a', u'b')), u'b then a')
+        self.assertEqual(self.expand(u'$1$3', (u'a',)), u'a$3')
+        self.assertEqual(self.expand(u'$10', (u'a',)), u'a0')
+        self.assertEqual(self.expand(u'$1', (u'$who',)), u'$who')
+
+class FactoidSnapshotTest(TestCase):
+    def setUp(self):
+        super(FactoidSnapshotTest, self).setUp()
+        self.snapshot = factoid.FactoidSnapshot(1, {
+            1: ((u'Foo',), ((1, u'is bar'), (2, u'<reply>baz'))),
+            2: ((u'foo $arg',), ((3, u'is wild $1'),)),
+        })
+
+    def test_exact(self):
+        self.assertEqual(self.snapshot.lookup(u'FOO', 1),
+                         (1, u'Foo', 1, u'is bar'))
+        self.assertEqual(self.snapshot.lookup(u'foo', 2),
+                         (1, u'Foo', 2, u'<reply>baz'))
+        self.assertEqual(self.snapshot.lookup(u'foo', None, u'BA', False)[0], 1)
+        self.assertEqual(self.snapshot.lookup(u'foo', None, u'^is', True),
+                         (1, u'Foo', 1, u'is bar'))
+
+    def test_wild(self):
+        self.assertEqual(self.snapshot.lookup(u'foo thing'),
+                         (2, u'foo $arg', 3, u'is wild $1'))
+        self.assertEqual(self.snapshot.lookup(u'foo', 3), None)
+        self.assertEqual(self.snapshot.lookup(u'bar'), None)
+
+    def test_patch(self):
+        patched = self.snapshot.patch({
+            2: ((u'foo $arg', u'quux'), ((3, u'is wild $1'),)),
+        }, (1, 2))
+        self.assertEqual(patched.version, 2)
+        self.assertEqual(patched.lookup(u'foo'), None)
+        self.assertEqual(patched.lookup(u'quux')[0], 2)
+        self.assertEqual(self.snapshot.lookup(u'foo', 1)[0], 1)
@@ -0,0 +1,326 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from calendar import timegm
+from datetime import datetime
+import gzip
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import ibid
+from ibid.event import Event
+from ibid.test import TestCase, TestSource
+from ibid.plugins import log
+
+class LogSearchTest(TestCase):
+    def test_tokenize(self):
+        self.assertEqual(log.tokenize(u'Hello, hello World! a'),
+                         set([u'hello', u'world']))
+
+    def test_format_regex(self):
+        regex = log.format_regex(u'%(timestamp)s <%(sender_nick)s> %(message)s')
+        match = regex.match(u'2011-01-01 12:00:00+0200 <bob> hi <there>')
+        self.assertEqual(match.group('timestamp'), u'2011-01-01 12:00:00+0200')
+        self.assertEqual(match.group('sender_nick'), u'bob')
+        self.assertEqual(match.group('message'), u'hi <there>')
+
+    def test_filename_regex(self):
+        regex = log.format_regex(
+                u'logs/%(year)d/%(month)02d/%(source)s/%(channel)s.log')
+        match = regex.search(u'/srv/ibid/logs/2011/01/atrum/#ibid.log')
+        self.assertEqual(match.group('source'), u'atrum')
+        self.assertEqual(match.group('channel'), u'#ibid')
+        self.failIf(regex.search(u'/srv/ibid/logs/2011/01/atrum/#ibid.log.gz'))
+
+class FakeDatabases(object):
+    def __init__(self, session):
+        self.ibid = session
+
+class LogIndexTest(TestCase):
+    "Search an in-memory index"
+
+    lines = [
+        (u'atrum', u'#ibid', u'bob', u'the build is broken again'),
+        (u'atrum', u'#ibid', u'alice', u'I fixed the build'),
+        (u'atrum', u'#ibid', u'bob', u'thanks, the build works now'),
+        (u'atrum', u'#other', u'carol', u'whose build is this?'),
+    ]
+
+    def setUp(self):
+        super(LogIndexTest, self).setUp()
+        engine = create_engine('sqlite://')
+        log.LogLine.__table__.create(engine)
+        log.LogWord.__table__.create(engine)
+        self.Session = sessionmaker(bind=engine)
+        self.session = self.Session()
+        log.store_lines(self.session, [{
+            'source': source,
+            'channel': channel,
+            'time': datetime(2011, 1, 1, 12, i),
+            'type': u'message',
+            'nick': nick,
+            'message': message,
+        } for i, (source, channel, nick, message) in enumerate(self.lines)])
+        self.session.commit()
+
+        self.databases = ibid.databases
+        ibid.databases = FakeDatabases(self.Session)
+        self.channels = ibid.channels.copy()
+        ibid.sources[u'atrum'] = TestSource()
+
+    def tearDown(self):
+        ibid.databases = self.databases
+        ibid.channels.clear()
+        ibid.channels.update(self.channels)
+        del ibid.sources[u'atrum']
+        self.session.close()
+        super(LogIndexTest, self).tearDown()
+
+    def test_search(self):
+        lines = log.search_logs(self.session, u'the build', u'atrum', u'#ibid')
+        self.assertEqual([line.message for line in lines], [
+            u'thanks, the build works now',
+            u'I fixed the build',
+            u'the build is broken again',
+        ])
+
+    def test_search_filters(self):
+        lines = log.search_logs(self.session, u'build', nick=u'bob',
+                                since=datetime(2011, 1, 1, 12, 1))
+        self.assertEqual([line.message for line in lines],
+                         [u'thanks, the build works now'])
+        self.assertEqual(log.search_logs(self.session, u'build broken fixed'),
+                         [])
+        self.assertEqual(log.search_logs(self.session, u'a'), [])
+
+    def make_event(self, channel=u'#ibid', public=True):
+        event = Event(u'atrum', u'message')
+        event.identity = 1
+        event.sender['nick'] = u'bob'
+        event.channel = channel
+        event.public = public
+        event.time = datetime(2011, 1, 1, 13, 0)
+        event.session = self.session
+        return event
+
+    def test_grep(self):
+        processor = log.SearchLogs(u'searchlogs')
+        event = self.make_event()
+        processor.grep(event, None, u'alice', None, None, u'build')
+        self.assertEqual([response['reply'] for response in event.responses],
+                         [u'[%s] <alice> I fixed the build'
+                          % log.format_date(datetime(2011, 1, 1, 12, 1))])
+
+    def test_grep_membership(self):
+        processor = log.SearchLogs(u'searchlogs')
+        event = self.make_event()
+        processor.grep(event, u'#other', None, None, None, u'build')
+        self.assertEqual(event.responses[0]['reply'], u"Sorry, you can only "
+                         u"search the logs of channels you're in")
+
+        ibid.channels[u'atrum'][u'#other'].add(1)
+        event = self.make_event()
+        processor.grep(event, u'#other', None, None, None, u'build')
+        self.assertEqual(len(event.responses), 1)
+        self.assertTrue(event.responses[0]['reply']
+                        .endswith(u'<carol> whose build is this?'))
+
+    def test_grep_private(self):
+        processor = log.SearchLogs(u'searchlogs')
+        event = self.make_event(channel=u'bob', public=False)
+        processor.grep(event, None, None, None, None, u'build')
+        self.assertEqual(event.responses[0]['reply'],
+                         u'Which channel should I search?')
+
+    def test_remote_search(self):
+        processor = log.SearchLogs(u'searchlogs')
+        processor.rpc_globs = log.compile_globs([u'atrum:#ibid'])
+        results = processor.remote_search(u'build', u'atrum', u'#ibid',
+                                          nick=u'alice')
+        self.assertEqual(results, [{
+            'source': u'atrum',
+            'channel': u'#ibid',
+            'time': '2011-01-01T12:01:00Z',
+            'type': u'message',
+            'nick': u'alice',
+            'message': u'I fixed the build',
+        }])
+
+    def test_remote_search_refused(self):
+        processor = log.SearchLogs(u'searchlogs')
+        processor.rpc_globs = log.compile_globs([u'atrum:#ibid'])
+        self.assertRaises(ValueError, processor.remote_search,
+                          u'build', u'atrum', u'#other')
+        self.assertRaises(ValueError, processor.remote_search, u'build')
+        processor.rpc_globs = []
+        self.assertRaises(ValueError, processor.remote_search,
+                          u'build', u'atrum', u'#ibid')
+
+    def test_private_not_indexed(self):
+        class Writer(object):
+            def __init__(self):
+                self.indexed = []
+            def write(self, filename, mode, line):
+                pass
+            def index(self, line):
+                self.indexed.append(line['message'])
+
+        processor = log.Log.__new__(log.Log)
+        processor.name = u'log'
+        processor.index = True
+        processor.writer = Writer()
+        processor.public_globs = processor.blacklist_globs = \
+                processor.whitelist_globs = []
+        processor.policies = log.LRUCache(10)
+
+        for channel, public, message in ((u'#ibid', True, u'in public'),
+                                         (u'bob', False, u'in private')):
+            event = self.make_event(channel, public)
+            event.sender.update({'id': u'bob', 'connection': u'bob!b@host'})
+            event.message = {'raw': message}
+            processor.log_event(event)
+        self.assertEqual(processor.writer.indexed, [u'in public'])
+
+    def test_index_logfile(self):
+        "What scripts/ibid-index-logs does for each file"
+        base = self.mktemp()
+        directory = os.path.join(base, 'logs', '2011', '01', 'atrum')
+        os.makedirs(directory)
+        filename = os.path.join(directory, '#ibid.log')
+        output = open(filename, 'w')
+        output.write('2011-01-01 12:00:00+0000 <bob> the build is broken again\n'
+                     '2011-01-01 12:00:30+0000 bob (bob!b@host) is now offline\n'
+                     '2011-01-01 12:05:00+0000 * dave rebuilds the build index\n')
+        output.close()
+
+        processor = log.Log.__new__(log.Log)
+        processor.name = u'log'
+        self.assertEqual(processor.index_logfile(self.session, filename), 2)
+        # The file replaced what was indexed for its period
+        lines = log.search_logs(self.session, u'build', u'atrum', u'#ibid')
+        self.assertEqual([(line.nick, line.type, line.message)
+                          for line in lines], [
+            (u'dave', u'action', u'rebuilds the build index'),
+            (u'bob', u'message', u'the build is broken again'),
+        ])
+
+class LogRotationTest(TestCase):
+    "Rotate logs in a temporary directory, against a fixed clock"
+
+    def setUp(self):
+        super(LogRotationTest, self).setUp()
+        self.base = os.path.abspath(self.mktemp())
+        os.makedirs(self.base)
+        self.options = ibid.options.copy()
+        ibid.options['base'] = self.base
+        ibid.sources[u'atrum'] = TestSource()
+
+        self.processor = log.Log.__new__(log.Log)
+        self.processor.name = u'log'
+        self.processor.date_utc = True
+        self.processor.public_globs = self.processor.blacklist_globs = \
+                self.processor.whitelist_globs = []
+        self.processor.policies = log.LRUCache(10)
+        self.processor.writer = log.LogWriter()
+        self.processor.writer.start()
+
+    def tearDown(self):
+        self.processor.writer.stop(5)
+        del ibid.sources[u'atrum']
+        ibid.options.clear()
+        ibid.options.update(self.options)
+        super(LogRotationTest, self).tearDown()
+
+    def logfile(self, year, month):
+        return os.path.join(self.base, 'logs', str(year), '%02i' % month,
+                            'atrum', '#ibid.log')
+
+    def log(self, when, message):
+        event = Event(u'atrum', u'message')
+        event.sender = {'id': u'bob', 'connection': u'bob!b@host',
+                        'nick': u'bob'}
+        event.channel = u'#ibid'
+        event.public = True
+        event.time = when
+        event.message = {'raw': message}
+        self.processor.log_event(event)
+
+    def touch(self, filename, when):
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        open(filename, 'a').close()
+        timestamp = timegm(when.timetuple())
+        os.utime(filename, (timestamp, timestamp))
+
+    def test_period_boundary(self):
+        self.log(datetime(2011, 1, 31, 23, 59, 59), u'last in January')
+        self.log(datetime(2011, 2, 1, 0, 0, 0), u'first in February')
+        self.processor.writer.stop(5)
+        self.assertEqual(open(self.logfile(2011, 1)).read(),
+                '2011-01-31 23:59:59 <bob> last in January\n')
+        self.assertEqual(open(self.logfile(2011, 2)).read(),
+                '2011-02-01 00:00:00 <bob> first in February\n')
+
+    def test_compress(self):
+        self.processor.compress = True
+        self.processor.retention = 0
+        self.log(datetime(2011, 1, 31, 23, 59, 59), u'last in January')
+        self.log(datetime(2011, 2, 1, 0, 0, 0), u'first in February')
+        january, february = self.logfile(2011, 1), self.logfile(2011, 2)
+        self.processor.writer.close(january, 5)
+        self.processor.writer.close(february, 5)
+        self.touch(january, datetime(2011, 1, 31, 23, 59, 59))
+        self.touch(february, datetime(2011, 2, 1, 1, 30))
+
+        # Too soon after the period ended, lines may still be queued
+        self.processor.rotate_logs(timegm((2011, 2, 1, 0, 30, 0)))
+        self.failUnless(os.path.exists(january))
+
+        self.processor.rotate_logs(timegm((2011, 2, 1, 2, 0, 0)))
+        self.failIf(os.path.exists(january))
+        self.assertEqual(gzip.open(january + '.gz').read(),
+                '2011-01-31 23:59:59 <bob> last in January\n')
+        self.assertEqual(os.stat(january + '.gz').st_mtime,
+                         timegm((2011, 1, 31, 23, 59, 59)))
+        # The current period is left alone
+        self.assertEqual(open(february).read(),
+                '2011-02-01 00:00:00 <bob> first in February\n')
+        self.failIf(os.path.exists(february + '.gz'))
+
+    def test_retention(self):
+        self.processor.compress = False
+        self.processor.retention = 30
+        november, december = self.logfile(2010, 11), self.logfile(2010, 12)
+        january, february = self.logfile(2011, 1), self.logfile(2011, 2)
+        other = os.path.join(self.base, 'logs', 'notes.txt')
+        self.touch(november + '.gz', datetime(2010, 11, 30, 23, 0))
+        self.touch(december, datetime(2010, 12, 31, 23, 0))
+        self.touch(january, datetime(2011, 1, 31, 23, 0))
+        self.touch(february, datetime(2010, 1, 1))
+        self.touch(other, datetime(2009, 1, 1))
+
+        self.processor.rotate_logs(timegm((2011, 2, 15, 0, 0, 0)))
+        self.failIf(os.path.exists(november + '.gz'))
+        self.failIf(os.path.exists(december))
+        self.failUnless(os.path.exists(january))
+        # Files for the current period, and files that aren't logs, stay
+        self.failUnless(os.path.exists(february))
+        self.failUnless(os.path.exists(other))
+
+    def test_period_over(self):
+        now = datetime(2011, 2, 15, 12, 0)
+        self.failUnless(self.processor.period_over(
+                {'year': '2011', 'month': '01'}, now))
+        self.failUnless(self.processor.period_over(
+                {'year': '2010', 'month': '12'}, now))
+        self.failIf(self.processor.period_over(
+                {'year': '2011', 'month': '02'}, now))
+        self.failIf(self.processor.period_over(
+                {'year': '2011', 'month': '02', 'day': '15'}, now))
+        self.failUnless(self.processor.period_over(
+                {'year': '2011', 'month': '02', 'day': '14'}, now))
+        self.failIf(self.processor.period_over({'source': 'atrum'}, now))
+
+# vi: set et sta sw=4 ts=4:
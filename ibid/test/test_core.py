@@ -4,9 +4,13 @@ from datetime import datetime, timedelta
 
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.python.threadable import isInIOThread
 
 import ibid
 from ibid import core, event
+from ibid.auth import AuthenticationPending
+from ibid.plugins import Processor, handler
+from ibid.test import TestCase
 
 
 def _defer_cb(dfr, *args, **kw):
@@ -307,6 +311,32 @@ class TestDispatcher(unittest.TestCase):
                                 'conflate': True}], src._msgs)
         return self._dispatch_and_assert(_cb, ev)
 
+    def test_dispatch_auth_pending(self):
+        "Processing resumes where it waited for an authentication."
+        ev = self._ev()
+        procs = []
+        def first(e):
+            procs.append('first')
+        def waiting(e):
+            procs.append('waiting')
+            if 'auth_results' not in e:
+                def lookup(value):
+                    procs.append(isInIOThread())
+                    return value
+                pending = AuthenticationPending(lookup, True)
+                pending.method = 'test'
+                raise pending
+            e.addresponse(u'authenticated: %s' % e.auth_results['test'])
+        self._add_processor(first)
+        self._add_processor(waiting)
+        def _cb(_ev, _self):
+            _self.assertEqual(['first', 'waiting', True, 'waiting'], procs)
+            _self.assertTrue('complain' not in _ev)
+            _self.assertTrue('auth_pending' not in _ev)
+            _self.assertEqual(u'authenticated: True',
+                              _ev.responses[0]['reply'])
+        return self._dispatch_and_assert(_cb, ev)
+
     def test_call_later_no_args(self):
         "Calling later calls stuff later."
         ev = self._ev()
@@ -418,3 +448,51 @@ class TestDispatcher(unittest.TestCase):
         return dfr
 
 # vi: set et sta sw=4 ts=4:
+
+class PendingAuth(object):
+    "Answers authentication checks after waiting, like NickServ"
+
+    def authenticate(self, event):
+        if 'auth_results' not in event:
+            pending = AuthenticationPending(defer.succeed, True)
+            pending.method = 'test'
+            raise pending
+        return event.auth_results['test']
+
+class TestAuthenticationPending(TestCase):
+    """
+    Test resuming Processor handlers that waited for authentication.
+    """
+
+    def setUp(self):
+        super(TestAuthenticationPending, self).setUp()
+        ibid.processors[:] = []
+        self.auth = ibid.auth
+        ibid.auth = PendingAuth()
+        self.dispatcher = core.Dispatcher()
+
+    def tearDown(self):
+        ibid.processors[:] = []
+        ibid.auth = self.auth
+        super(TestAuthenticationPending, self).tearDown()
+
+    def test_resume_after_response(self):
+        "A handler that responded before authenticating responds once."
+        calls = []
+        class Responder(Processor):
+            addressed = False
+            @handler
+            def respond(self, event):
+                calls.append('respond')
+                event.addresponse(u'checking')
+                if ibid.auth.authenticate(event):
+                    event.addresponse(u'authenticated')
+        ibid.processors.append(Responder(u'responder'))
+
+        ev = event.Event('fakesource', 'message')
+        def _cb(_ev):
+            self.assertEqual(['respond', 'respond'], calls)
+            self.assertEqual([u'checking', u'authenticated'],
+                             [response['reply'] for response in _ev.responses])
+            self.assertTrue('complain' not in _ev)
+        return self.dispatcher.dispatch(ev).addCallback(_cb)
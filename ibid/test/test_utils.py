@@ -2,15 +2,113 @@
 # Released under terms of the MIT/X/Expat Licence. See COPYING for details.
 
 import datetime
+import random
+import re
 
 import ibid.test
 import ibid.utils
+from ibid.utils.cache import LRUCache
 
 class TestUtils(ibid.test.TestCase):
     def test_ago(self):
         self.assertEqual(ibid.utils.ago(datetime.timedelta(seconds=60)), u'1 minute')
         self.assertEqual(ibid.utils.ago(datetime.timedelta(seconds=60000), 1), u'16 hours')
 
+class TestLRUCache(ibid.test.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=-1)
+        cache['a'] = 1
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.get('a', 'gone'), 'gone')
+        self.assertRaises(KeyError, lambda: cache['a'])
+
+    def test_discard(self):
+        cache = LRUCache(10)
+        for i in range(6):
+            cache[i] = i % 2
+        self.assertEqual(cache.discard(lambda key, value: value == 1), 3)
+        self.assertEqual(sorted(cache.map.keys()), [0, 2, 4])
+        cache.resize(1)
+        self.assertEqual(cache.map.keys(), [4])
+
+    def test_on_evict(self):
+        evicted = []
+        cache = LRUCache(2, on_evict=lambda key, value: evicted.append(key))
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(evicted, ['b'])
+        self.assertEqual(cache.items(), [('a', 1), ('c', 3)])
+
+# Strings that URLPattern and is_url must treat exactly like the TLD
+# alternation regex they replace.
+url_corpus = [
+    u'google.com', u'http://foo.bar', u'aoeuoeu <www.jar.com> def',
+    u'joe (www.google.com) says foo', u"'http://bar.com'",
+    u'Thingie boo.com/a eue', u'ftp.debian.org/debian/', u'FTP.Debian.ORG',
+    u'http://en.example.org/wiki/Python_(programming_language)',
+    u'<URL:http://en.example.org/wiki/Python_(programming_language)> lekker',
+    u'joe@bar.com', u'<joe@bar.za.net>', u'x joe@google.com.',
+    u'File "/usr/lib/python2.5/httplib.py", line 866, in request',
+    u'I think we should merge this before the release. Any objections?',
+    u'e.g. foo.bar, i.e. baz.qux', u'see foo.com.', u'foo.comx bar.co.uk',
+    u'a.com/b.c/d', u'foo.com.zz', u'foo.c-om', u'foo.com2 bar.org:80',
+    u'xn--0zwm56d.xn--0zwm56d', u'www.', u'www. foo', u'http://',
+    u'http:// foo', u'svn+ssh://host/repo', u'.com', u'..com', u'a..com',
+    u'foo.com); bar', u'"quoted.net"', u'[link.org]', u'1.2.3.4',
+    u'version 2.6.za', u'trailing.org\n', u'tab\tsep.net\there',
+]
+
+class TestURLPattern(ibid.test.TestCase):
+    prefix = r'(?:[^@./]\b(?!\.)|\A)('
+    suffix = r')[\[>)\]"\'.,;:]*(?:\s|\Z)'
+
+    def corpus(self):
+        # Plus random strings made of the pieces that matter to URLs
+        pieces = [u'a', u'b', u'co', u'com', u'uk', u'zz', u'xn--0zwm56d',
+                  u'Com', u'www', u'ftp', u'http://', u'-', u'2', u'_', u'.',
+                  u'.', u'/', u':', u'@', u' ', u'\t', u'\n', u'(', u')',
+                  u'<', u'>', u'[', u']', u'"', u"'", u',', u';', u'!']
+        rand = random.Random(42)
+        strings = list(url_corpus)
+        for i in xrange(20000):
+            strings.append(u''.join(rand.choice(pieces)
+                                    for j in xrange(rand.randint(1, 12))))
+        return strings
+
+    def test_search(self):
+        regex = re.compile(self.prefix + ibid.utils.url_regex() + self.suffix,
+                           re.I | re.DOTALL)
+        pattern = ibid.utils.URLPattern(self.prefix, self.suffix,
+                                        re.I | re.DOTALL)
+        for string in self.corpus():
+            expected = regex.search(string)
+            match = pattern.search(string)
+            if expected is None:
+                self.assertEqual(match, None, string)
+            else:
+                self.assertNotEqual(match, None, string)
+                self.assertEqual((match.start(), match.groups()),
+                                 (expected.start(), expected.groups()), string)
+
+    def test_is_url(self):
+        regex = re.compile('^' + ibid.utils.url_regex() + '$', re.I)
+        for string in self.corpus():
+            self.assertEqual(ibid.utils.is_url(string),
+                             regex.match(string) is not None, string)
+
 class TestUtilsNetwork(ibid.test.TestCase):
     network = True
 
@@ -0,0 +1,48 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+"""Compare the speed of URLPattern with the TLD alternation regex it
+replaces, on a mix of channel messages.
+Run with: python -m ibid.test.url_benchmark
+"""
+
+import re
+from timeit import Timer
+
+from ibid.test.test_utils import TestURLPattern
+from ibid.utils import URLPattern, url_regex
+
+messages = [
+    u'morning all',
+    u'ok',
+    u'I think we should merge this before the release. Any objections?',
+    u"nope, go for it. I'll tag it tonight, e.g. after dinner.",
+    u'File "/usr/lib/python2.5/httplib.py", line 866, in request',
+    u'has anyone tried the new version? it segfaults on startup for me.',
+    u'see http://www.example.net/blog/2008/11/09/debugging-python/ for details',
+    u'google.com is down again, try bing.com or duckduckgo.com.',
+    u'the patch is at <http://paste.example.org/12345> if you want it',
+    u'joe@example.com said he would look at it, ask him',
+]
+
+def main():
+    prefix, suffix = TestURLPattern.prefix, TestURLPattern.suffix
+    regex = re.compile(prefix + url_regex() + suffix, re.I | re.DOTALL)
+    pattern = URLPattern(prefix, suffix, re.I | re.DOTALL)
+
+    def run(search):
+        for message in messages:
+            search(message)
+
+    number = 2000
+    for name, search in (('regex', regex.search),
+                         ('URLPattern', pattern.search)):
+        timer = Timer(lambda: run(search))
+        best = min(timer.repeat(3, number))
+        print '%-12s %6.1f us/message' % (
+                name, best * 1e6 / number / len(messages))
+
+if __name__ == '__main__':
+    main()
+
+# vi: set et sta sw=4 ts=4:
@@ -58,20 +58,23 @@ def decode_htmlentities(text):
     return text
 
 downloads_in_progress = defaultdict(Lock)
-def cacheable_download(url, cachefile, headers={}, timeout=60):
+def cacheable_download(url, cachefile, headers={}, timeout=60, response=None):
     """Download url to cachefile if it's modified since cachefile.
     Specify cachefile in the form pluginname/cachefile.
+    If response is a dict, it is updated with the HTTP 'status' and
+    'headers' of the response.
     Returns complete path to downloaded file."""
 
     downloads_in_progress[cachefile].acquire()
     try:
-        f = _cacheable_download(url, cachefile, headers, timeout)
+        f = _cacheable_download(url, cachefile, headers, timeout, response)
     finally:
         downloads_in_progress[cachefile].release()
 
     return f
 
-def _cacheable_download(url, cachefile, headers={}, timeout=60):
+def _cacheable_download(url, cachefile, headers={}, timeout=60,
+                        response=None):
     # We do allow absolute paths, for people who know what they are doing,
     # but the common use case should be pluginname/cachefile.
     if cachefile[0] not in (os.sep, os.altsep):
@@ -116,6 +119,9 @@ def _cacheable_download(url, cachefile, headers={}, timeout=60):
             connection = urllib2.urlopen(req, **kwargs)
         except urllib2.HTTPError, e:
             if e.code == 304 and exists:
+                if response is not None:
+                    response['status'] = 304
+                    response['headers'] = e.headers
                 return cachefile
             else:
                 raise
@@ -124,6 +130,9 @@ def _cacheable_download(url, cachefile, headers={}, timeout=60):
             socket.setdefaulttimeout(None)
 
     data = connection.read()
+    if response is not None:
+        response['status'] = connection.code
+        response['headers'] = connection.headers
 
     compression = connection.headers.get('content-encoding')
     if compression:
@@ -222,32 +231,111 @@ def iri_to_uri(url):
     parts[2] = quote(parts[2].encode('utf-8'), '/%')
     return urlunparse(parts).encode('utf-8')
 
-_url_regex = None
+_tlds = None
 
-def url_regex():
-    global _url_regex
-    if _url_regex is not None:
-        return _url_regex
+def tlds():
+    "Return the set of known top level domains, in lower case"
+    global _tlds
+    if _tlds is not None:
+        return _tlds
 
     tldfile = locate_resource('ibid', 'data/tlds-alpha-by-domain.txt')
     if tldfile:
         f = file(tldfile, 'r')
-        tlds = [tld.strip().lower() for tld in f.readlines()
-                if not tld.startswith('#')]
+        _tlds = frozenset(tld.strip().lower() for tld in f.readlines()
+                          if not tld.startswith('#'))
         f.close()
     else:
         log.warning(u"Couldn't open TLD list, falling back to minimal default")
-        tlds = 'com.org.net.za'.split('.')
+        _tlds = frozenset('com.org.net.za'.split('.'))
+
+    return _tlds
 
-    _url_regex = (
+_url_regex = None
+
+def url_regex(any_tld=False):
+    """Return a regex fragment matching URLs.
+    With any_tld, the TLD isn't checked, and matches must be filtered with
+    URLPattern.
+    """
+    global _url_regex
+    template = (
         r'(?:\w+://|(?:www|ftp)\.)\S+?' # Match an explicit URL or guess by www.
         r'|[^@\s:/]+\.(?:%s)(?:/\S*?)?' # Guess at the URL based on TLD
-    ) % '|'.join(tlds)
-
+    )
+    if any_tld:
+        return template % r'[a-z0-9-]+'
+    if _url_regex is None:
+        _url_regex = template % '|'.join(sorted(tlds()))
     return _url_regex
 
+_explicit_url_re = re.compile(r'(?:\w+://|(?:www|ftp)\.)\S', re.I)
+_tld_re = re.compile(r'[a-z0-9-]+', re.I)
+_tld_url_re = re.compile(r'[^@\s:/]+\.([a-z0-9-]+)(?:/\S*?)?$', re.I)
+_word_end_re = re.compile(r'\S*')
+
+class URLPattern(object):
+    """Matches like re.compile(prefix + url_regex() + suffix, flags), where
+    group is the group containing the URL.
+    Rather than matching the slow TLD alternation in url_regex() all over
+    the string, this scans for schemes, www., ftp. and known TLDs, and only
+    matches the words that contain them. TLDs are looked up in tlds().
+    prefix may match one character before the URL's word, and suffix must
+    end at the end of the word.
+    """
+
+    def __init__(self, prefix=u'', suffix=u'', flags=re.I, group=1):
+        self.regex = re.compile(prefix + url_regex(True) + suffix, flags)
+        self.group = group
+        self.tlds = tlds()
+
+    def _tld_hint(self, string, dot):
+        "Could the dot at this position be part of a URL?"
+        if string[max(0, dot - 3):dot].lower() in ('www', 'ftp'):
+            return True
+        tld = _tld_re.match(string, dot + 1)
+        return tld is not None and tld.group().lower() in self.tlds
+
+    def search(self, string):
+        scheme = string.find('://')
+        dot = string.find('.')
+        pos = end = 0
+        while scheme != -1 or dot != -1:
+            if dot == -1 or scheme != -1 and scheme < dot:
+                hint = scheme
+                scheme = string.find('://', scheme + 3)
+                if hint < end:
+                    continue
+            else:
+                hint = dot
+                dot = string.find('.', dot + 1)
+                if hint < end or not self._tld_hint(string, hint):
+                    continue
+
+            # Earlier words have nothing that could be part of a URL, so
+            # matches can only start in this one
+            end = _word_end_re.match(string, hint).end()
+            while True:
+                match = self.regex.search(string, pos, end)
+                if match is None:
+                    break
+                if self._valid(match.group(self.group)):
+                    return match
+                pos = match.start() + 1
+            pos = end
+        return None
+
+    def _valid(self, url):
+        if _explicit_url_re.match(url):
+            return True
+        host = url.split('/', 1)[0]
+        return host.rsplit('.', 1)[-1].lower() in self.tlds
+
 def is_url(url):
-    return re.match('^' + url_regex() + '$', url, re.I) is not None
+    if _explicit_url_re.match(url):
+        return True
+    match = _tld_url_re.match(url)
+    return match is not None and match.group(1).lower() in tlds()
 
 def generic_webservice(url, params={}, headers={}):
     "Retreive data from a webservice"
@@ -0,0 +1,166 @@
+# Copyright (c) 2011, Ibid Developers
+# Released under terms of the MIT/X/Expat Licence. See COPYING for details.
+
+from threading import Lock
+from time import time
+
+_missing = object()
+
+class LRUCache(object):
+    """A thread-safe mapping, holding at most size entries.
+    The least recently used entries are discarded first.
+    If ttl (in seconds) is specified, entries expire that long after they
+    were stored.
+    If on_evict is specified, it is called with (key, value) for every entry
+    discarded to make room, while the cache is locked.
+    """
+
+    def __init__(self, size=1000, ttl=None, on_evict=None):
+        self.size = size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            # key -> [prev, next, key, value, expires]
+            self.map = {}
+            self.root = root = []
+            root[:] = [root, root, None, None, None]
+            self.hits = self.misses = self.evictions = 0
+        finally:
+            self.lock.release()
+
+    def _unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, node):
+        root = self.root
+        last = root[0]
+        node[0], node[1] = last, root
+        last[1] = root[0] = node
+
+    def _evict(self):
+        while len(self.map) > self.size:
+            oldest = self.root[1]
+            self._unlink(oldest)
+            del self.map[oldest[2]]
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(oldest[2], oldest[3])
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            node = self.map.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+            if node[4] is not None and node[4] < time():
+                self._unlink(node)
+                del self.map[key]
+                self.misses += 1
+                return default
+            self._unlink(node)
+            self._append(node)
+            self.hits += 1
+            return node[3]
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            node = self.map.get(key)
+            return node is not None and (node[4] is None or node[4] >= time())
+        finally:
+            self.lock.release()
+
+    def __setitem__(self, key, value):
+        expires = None
+        if self.ttl:
+            expires = time() + self.ttl
+        self.lock.acquire()
+        try:
+            node = self.map.get(key)
+            if node is not None:
+                self._unlink(node)
+                node[3], node[4] = value, expires
+            else:
+                node = self.map[key] = [None, None, key, value, expires]
+            self._append(node)
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def pop(self, key, default=None):
+        self.lock.acquire()
+        try:
+            node = self.map.pop(key, None)
+            if node is None:
+                return default
+            self._unlink(node)
+            return node[3]
+        finally:
+            self.lock.release()
+
+    def discard(self, predicate):
+        """Remove every entry for which predicate(key, value) is true.
+        Returns the number of entries removed.
+        """
+        self.lock.acquire()
+        try:
+            removed = [node for node in self.map.itervalues()
+                       if predicate(node[2], node[3])]
+            for node in removed:
+                self._unlink(node)
+                del self.map[node[2]]
+            return len(removed)
+        finally:
+            self.lock.release()
+
+    def resize(self, size):
+        self.lock.acquire()
+        try:
+            self.size = size
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def items(self):
+        "Return a list of (key, value), least recently used first"
+        self.lock.acquire()
+        try:
+            items = []
+            node = self.root[1]
+            while node is not self.root:
+                items.append((node[2], node[3]))
+                node = node[1]
+            return items
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.map)
+
+    def stats(self):
+        "Return a dict of cache statistics"
+        return {
+            'size': len(self.map),
+            'max_size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+# vi: set et sta sw=4 ts=4:
@@ -17,8 +17,12 @@ from ibid.utils import iri_to_uri
 class ContentTypeException(Exception):
     pass
 
-def get_html_parse_tree(url, data=None, headers={}, treetype='beautifulsoup'):
-    "Request a URL, parse with html5lib, and return a parse tree from it"
+def get_html_parse_tree(url, data=None, headers={}, treetype='beautifulsoup',
+                        max_size=None):
+    """Request a URL, parse with html5lib, and return a parse tree from it.
+    If max_size is specified, at most max_size bytes are downloaded and
+    parsed.
+    """
 
     req = urllib2.Request(iri_to_uri(url), data, headers)
     f = urllib2.urlopen(req)
@@ -27,7 +31,10 @@ def get_html_parse_tree(url, data=None, headers={}, treetype='beautifulsoup'):
         f.close()
         raise ContentTypeException("Content type isn't HTML, but " + f.info().gettype())
 
-    data = f.read()
+    if max_size is None:
+        data = f.read()
+    else:
+        data = f.read(max_size)
     f.close()
 
     encoding = None
@@ -37,7 +44,18 @@ def get_html_parse_tree(url, data=None, headers={}, treetype='beautifulsoup'):
         encoding = params.get('charset')
 
     compression = f.headers.get('content-encoding')
-    if compression:
+    if compression and max_size is not None:
+        # A truncated stream can only be decompressed incrementally
+        if compression.lower() == "deflate":
+            try:
+                data = zlib.decompressobj().decompress(data, max_size)
+            except zlib.error:
+                data = zlib.decompressobj(-zlib.MAX_WBITS) \
+                        .decompress(data, max_size)
+        elif compression.lower() == "gzip":
+            data = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                    .decompress(data, max_size)
+    elif compression:
         if compression.lower() == "deflate":
             try:
                 data = zlib.decompress(data)
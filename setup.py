@@ -57,6 +57,7 @@ setup(
         'scripts/ibid',
         'scripts/ibid-db',
         'scripts/ibid-factpack',
+        'scripts/ibid-index-logs',
         'scripts/ibid-knab-import',
         'scripts/ibid-memgraph',
         'scripts/ibid-objgraph',